@@ -0,0 +1,103 @@
+"""
+Predict-only benchmark of CapsNet with and without the reconstruction decoder.
+
+Builds the evaluation graph twice, once with the decoder and once stopping at
+the DigitCaps lengths, and times prediction on random images for several
+batch sizes. The full build fetches the reconstruction along with the
+classes, as a graph serving both would. Latency percentiles, variable bytes,
+graph size and the bytes allocated per step are written to a JSON report:
+
+    python benchmark_predict.py --batch_sizes 1,32,128 --num_batches 50
+"""
+
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import cfg
+from capsNet import CapsNet
+
+
+flags = tf.app.flags
+flags.DEFINE_string('batch_sizes', '1,32,128', 'comma separated batch sizes to time')
+flags.DEFINE_integer('num_batches', 50, 'number of timed batches per batch size')
+flags.DEFINE_integer('warmup_batches', 5, 'number of batches run before timing')
+flags.DEFINE_string('benchmark_output', 'predict_benchmark.json', 'path of the JSON report')
+
+
+def step_bytes(run_metadata):
+    '''Returns the bytes allocated for the outputs of every op of a step.'''
+    total = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for output in node_stats.output:
+                total += output.tensor_description.allocation_description.allocated_bytes
+    return total
+
+
+def benchmark(with_decoder, batch_sizes):
+    start = time.time()
+    model = CapsNet(is_training=False, with_decoder=with_decoder)
+    build_secs = time.time() - start
+
+    fetches = [model.argmax_idx]
+    if with_decoder:
+        fetches.append(model.decoded)
+
+    with model.graph.as_default():
+        variables = tf.global_variables()
+        result = {
+            'build_secs': build_secs,
+            'graph_bytes': model.graph.as_graph_def().ByteSize(),
+            'num_variables': len(variables),
+            'variable_bytes': sum(v.get_shape().num_elements() * v.dtype.size for v in variables),
+            'batch_sizes': {},
+        }
+        init = tf.global_variables_initializer()
+
+    with tf.Session(graph=model.graph) as sess:
+        sess.run(init)
+        for batch_size in batch_sizes:
+            feed = {model.X: np.random.rand(batch_size, 28, 28, 1).astype(np.float32),
+                    model.labels: np.random.randint(0, 10, batch_size)}
+            for _ in range(cfg.warmup_batches):
+                sess.run(fetches, feed)
+
+            latencies = []
+            for _ in range(cfg.num_batches):
+                tic = time.time()
+                sess.run(fetches, feed)
+                latencies.append((time.time() - tic) * 1000)
+
+            run_metadata = tf.RunMetadata()
+            sess.run(fetches, feed, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                     run_metadata=run_metadata)
+
+            result['batch_sizes'][batch_size] = {
+                'latency_ms': {'p50': float(np.percentile(latencies, 50)),
+                               'p90': float(np.percentile(latencies, 90)),
+                               'p99': float(np.percentile(latencies, 99))},
+                'images_per_sec': batch_size * 1000. / np.mean(latencies),
+                'step_bytes': step_bytes(run_metadata),
+            }
+    return result
+
+
+def main(_):
+    batch_sizes = [int(b) for b in cfg.batch_sizes.split(',') if b.strip()]
+    report = {
+        'with_decoder': benchmark(True, batch_sizes),
+        'without_decoder': benchmark(False, batch_sizes),
+    }
+    for name, result in sorted(report.items()):
+        for batch_size, stats in sorted(result['batch_sizes'].items()):
+            print('%s, batch %d: p50 %.2f ms, %d bytes per step' % (
+                name, batch_size, stats['latency_ms']['p50'], stats['step_bytes']))
+    with open(cfg.benchmark_output, 'w') as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+    print('Benchmark has been saved to ' + cfg.benchmark_output)
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -4,7 +4,6 @@ Author: Huadong Liao
 E-mail: naturomics.liao@gmail.com
 """
 
-import numpy as np
 import tensorflow as tf
 
 from config import cfg
@@ -44,7 +43,7 @@ class CapsLayer(object):
             if not self.with_routing:
                 # the PrimaryCaps layer, a convolutional layer
                 # input: [batch_size, 20, 20, 256]
-                assert input.get_shape() == [cfg.batch_size, 20, 20, 256]
+                assert input.get_shape()[1:] == [20, 20, 256]
 
                 '''
                 # version 1, computational expensive
@@ -57,7 +56,7 @@ class CapsLayer(object):
                                                           padding="VALID", activation_fn=None)
                         caps_i = tf.reshape(caps_i, shape=(cfg.batch_size, -1, 1, 1))
                         capsules.append(caps_i)
-                assert capsules[0].get_shape() == [cfg.batch_size, 1152, 1, 1]
+                assert capsules[0].get_shape()[1:] == [1152, 1, 1]
                 capsules = tf.concat(capsules, axis=2)
                 '''
 
@@ -73,23 +72,25 @@ class CapsLayer(object):
                 # capsules = tf.contrib.layers.conv2d(input, self.num_outputs * self.vec_len,
                 #                                    self.kernel_size, self.stride,padding="VALID",
                 #                                    activation_fn=None)
-                capsules = tf.reshape(capsules, (cfg.batch_size, -1, self.vec_len, 1))
+                num_caps = capsules.shape[1].value * capsules.shape[2].value * self.num_outputs
+                capsules = tf.reshape(capsules, (-1, num_caps, self.vec_len, 1))
 
                 # [batch_size, 1152, 8, 1]
                 capsules = squash(capsules)
-                assert capsules.get_shape() == [cfg.batch_size, 1152, 8, 1]
+                assert capsules.get_shape()[1:] == [1152, 8, 1]
                 return(capsules)
 
         if self.layer_type == 'FC':
             if self.with_routing:
                 # the DigitCaps layer, a fully connected layer
                 # Reshape the input into [batch_size, 1152, 1, 8, 1]
-                self.input = tf.reshape(input, shape=(cfg.batch_size, -1, 1, input.shape[-2].value, 1))
+                self.input = tf.reshape(input, shape=(-1, input.shape[1].value, 1, input.shape[-2].value, 1))
 
                 with tf.variable_scope('routing'):
                     # b_IJ: [batch_size, num_caps_l, num_caps_l_plus_1, 1, 1],
                     # about the reason of using 'batch_size', see issue #21
-                    b_IJ = tf.constant(np.zeros([cfg.batch_size, input.shape[1].value, self.num_outputs, 1, 1], dtype=np.float32))
+                    # the batch dim is taken from the input, so that any batch size can be fed
+                    b_IJ = tf.zeros([tf.shape(input)[0], input.shape[1].value, self.num_outputs, 1, 1], dtype=tf.float32)
                     capsules = routing(self.input, b_IJ)
                     capsules = tf.squeeze(capsules, axis=1)
 
@@ -115,20 +116,18 @@ def routing(input, b_IJ):
                         initializer=tf.random_normal_initializer(stddev=cfg.stddev))
 
     # Eq.2, calc u_hat
-    # do tiling for input and W before matmul
-    # input => [batch_size, 1152, 10, 8, 1]
-    # W => [batch_size, 1152, 10, 8, 16]
-    input = tf.tile(input, [1, 1, 10, 1, 1])
-    W = tf.tile(W, [cfg.batch_size, 1, 1, 1, 1])
-    assert input.get_shape() == [cfg.batch_size, 1152, 10, 8, 1]
-
-    # in last 2 dims:
-    # [8, 16].T x [8, 1] => [16, 1] => [batch_size, 1152, 10, 16, 1]
-    # tf.scan, 3 iter, 1080ti, 128 batch size: 10min/epoch
-    # u_hat = tf.scan(lambda ac, x: tf.matmul(W, x, transpose_a=True), input, initializer=tf.zeros([1152, 10, 16, 1]))
-    # tf.tile, 3 iter, 1080ti, 128 batch size: 6min/epoch
-    u_hat = tf.matmul(W, input, transpose_a=True)
-    assert u_hat.get_shape() == [cfg.batch_size, 1152, 10, 16, 1]
+    # one batched matmul over the 1152 input capsules, without tiling input
+    # or W over the batch:
+    # input => [1152, batch_size, 8]
+    # W => [1152, 8, 10 * 16]
+    input = tf.transpose(tf.reshape(input, shape=(-1, 1152, 8)), perm=[1, 0, 2])
+    W = tf.reshape(tf.transpose(W, perm=[0, 1, 3, 2, 4]), shape=(1152, 8, 10 * 16))
+
+    # batched over the 1152 capsules, [batch_size, 8] x [8, 160] for each:
+    # [1152, batch_size, 160] => [batch_size, 1152, 10, 16, 1]
+    u_hat = tf.transpose(tf.matmul(input, W), perm=[1, 0, 2])
+    u_hat = tf.reshape(u_hat, shape=(-1, 1152, 10, 16, 1))
+    assert u_hat.get_shape()[1:] == [1152, 10, 16, 1]
 
     # In forward, u_hat_stopped = u_hat; in backward, no gradient passed back from u_hat_stopped to u_hat
     u_hat_stopped = tf.stop_gradient(u_hat, name='stop_gradient')
@@ -148,24 +147,23 @@ def routing(input, b_IJ):
                 s_J = tf.multiply(c_IJ, u_hat)
                 # then sum in the second dim, resulting in [batch_size, 1, 10, 16, 1]
                 s_J = tf.reduce_sum(s_J, axis=1, keep_dims=True)
-                assert s_J.get_shape() == [cfg.batch_size, 1, 10, 16, 1]
+                assert s_J.get_shape()[1:] == [1, 10, 16, 1]
 
                 # line 6:
                 # squash using Eq.1,
                 v_J = squash(s_J)
-                assert v_J.get_shape() == [cfg.batch_size, 1, 10, 16, 1]
+                assert v_J.get_shape()[1:] == [1, 10, 16, 1]
             elif r_iter < cfg.iter_routing - 1:  # Inner iterations, do not apply backpropagation
                 s_J = tf.multiply(c_IJ, u_hat_stopped)
                 s_J = tf.reduce_sum(s_J, axis=1, keep_dims=True)
                 v_J = squash(s_J)
 
                 # line 7:
-                # reshape & tile v_j from [batch_size ,1, 10, 16, 1] to [batch_size, 1152, 10, 16, 1]
-                # then matmul in the last tow dim: [16, 1].T x [16, 1] => [1, 1], reduce mean in the
-                # batch_size dim, resulting in [1, 1152, 10, 1, 1]
-                v_J_tiled = tf.tile(v_J, [1, 1152, 1, 1, 1])
-                u_produce_v = tf.matmul(u_hat_stopped, v_J_tiled, transpose_a=True)
-                assert u_produce_v.get_shape() == [cfg.batch_size, 1152, 10, 1, 1]
+                # dot product of u_hat and v_j in the vec_len dim, v_j of shape
+                # [batch_size, 1, 10, 16, 1] being broadcast over the 1152 input
+                # capsules instead of tiled, resulting in [batch_size, 1152, 10, 1, 1]
+                u_produce_v = tf.reduce_sum(u_hat_stopped * v_J, axis=3, keep_dims=True)
+                assert u_produce_v.get_shape()[1:] == [1152, 10, 1, 1]
 
                 # b_IJ += tf.reduce_sum(u_produce_v, axis=0, keep_dims=True)
                 b_IJ += u_produce_v
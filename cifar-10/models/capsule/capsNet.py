@@ -15,7 +15,16 @@ epsilon = 1e-9
 
 
 class CapsNet(object):
-    def __init__(self, is_training=True):
+    def __init__(self, is_training=True, with_decoder=False):
+        '''
+        Args:
+            is_training: build the training graph, fed by the input pipeline,
+                else an evaluation graph fed through placeholders.
+            with_decoder: build the reconstruction decoder when evaluating. It
+                is always built when training. Without it, the evaluation graph
+                stops at the DigitCaps lengths, see export.
+        '''
+        self.with_decoder = is_training or with_decoder
         self.graph = tf.Graph()
         with self.graph.as_default():
             if is_training:
@@ -23,6 +32,7 @@ class CapsNet(object):
                 self.Y = tf.one_hot(self.labels, depth=10, axis=1, dtype=tf.float32)
 
                 self.build_arch()
+                self.build_decoder()
                 self.loss()
                 self._summary()
 
@@ -31,10 +41,13 @@ class CapsNet(object):
                 self.optimizer = tf.train.AdamOptimizer()
                 self.train_op = self.optimizer.minimize(self.total_loss, global_step=self.global_step)  # var_list=t_vars)
             else:
-                self.X = tf.placeholder(tf.float32, shape=(cfg.batch_size, 28, 28, 1))
-                self.labels = tf.placeholder(tf.int32, shape=(cfg.batch_size, ))
-                self.Y = tf.reshape(self.labels, shape=(cfg.batch_size, 10, 1))
+                # the batch dim is left undefined, so that any batch size can be fed
+                self.X = tf.placeholder(tf.float32, shape=(None, 28, 28, 1))
+                self.labels = tf.placeholder(tf.int32, shape=(None, ))
+                self.Y = tf.one_hot(self.labels, depth=10, axis=1, dtype=tf.float32)
                 self.build_arch()
+                if self.with_decoder:
+                    self.build_decoder()
 
         tf.logging.info('Seting up the main structure')
 
@@ -44,13 +57,13 @@ class CapsNet(object):
             conv1 = tf.contrib.layers.conv2d(self.X, num_outputs=256,
                                              kernel_size=9, stride=1,
                                              padding='VALID')
-            assert conv1.get_shape() == [cfg.batch_size, 20, 20, 256]
+            assert conv1.get_shape()[1:] == [20, 20, 256]
 
         # Primary Capsules layer, return [batch_size, 1152, 8, 1]
         with tf.variable_scope('PrimaryCaps_layer'):
             primaryCaps = CapsLayer(num_outputs=32, vec_len=8, with_routing=False, layer_type='CONV')
             caps1 = primaryCaps(conv1, kernel_size=9, stride=2)
-            assert caps1.get_shape() == [cfg.batch_size, 1152, 8, 1]
+            assert caps1.get_shape()[1:] == [1152, 8, 1]
 
         # DigitCaps layer, return [batch_size, 10, 16, 1]
         with tf.variable_scope('DigitCaps_layer'):
@@ -65,42 +78,66 @@ class CapsNet(object):
             self.v_length = tf.sqrt(tf.reduce_sum(tf.square(self.caps2),
                                                   axis=2, keep_dims=True) + epsilon)
             self.softmax_v = tf.nn.softmax(self.v_length, dim=1)
-            assert self.softmax_v.get_shape() == [cfg.batch_size, 10, 1, 1]
+            assert self.softmax_v.get_shape()[1:] == [10, 1, 1]
 
             # b). pick out the index of max softmax val of the 10 caps
             # [batch_size, 10, 1, 1] => [batch_size] (index)
             self.argmax_idx = tf.to_int32(tf.argmax(self.softmax_v, axis=1))
-            assert self.argmax_idx.get_shape() == [cfg.batch_size, 1, 1]
-            self.argmax_idx = tf.reshape(self.argmax_idx, shape=(cfg.batch_size, ))
+            assert self.argmax_idx.get_shape()[1:] == [1, 1]
+            self.argmax_idx = tf.reshape(self.argmax_idx, shape=(-1, ))
+
+            # [batch_size, 10, 1, 1] => [batch_size, 10], served by export
+            self.lengths = tf.reshape(self.v_length, shape=(-1, 10))
+
+        correct_prediction = tf.equal(tf.to_int32(self.labels), self.argmax_idx)
+        self.accuracy = tf.reduce_sum(tf.cast(correct_prediction, tf.float32))
 
+    def build_decoder(self):
+        with tf.variable_scope('Masking'):
             # Method 1.
             if not cfg.mask_with_y:
                 # c). indexing
-                # It's not easy to understand the indexing process with argmax_idx
-                # as we are 3-dim animal
-                masked_v = []
-                for batch_size in range(cfg.batch_size):
-                    v = self.caps2[batch_size][self.argmax_idx[batch_size], :]
-                    masked_v.append(tf.reshape(v, shape=(1, 1, 16, 1)))
-
-                self.masked_v = tf.concat(masked_v, axis=0)
-                assert self.masked_v.get_shape() == [cfg.batch_size, 1, 16, 1]
+                # mask the 10 capsules with the one-hot argmax_idx over the
+                # whole batch, then sum the masked ones out
+                # [batch_size, 10, 16, 1] => [batch_size, 1, 16, 1]
+                mask = tf.one_hot(self.argmax_idx, depth=10, axis=1, dtype=tf.float32)
+                self.masked_v = tf.reduce_sum(self.caps2 * tf.reshape(mask, (-1, 10, 1, 1)),
+                                              axis=1, keep_dims=True)
+                assert self.masked_v.get_shape()[1:] == [1, 16, 1]
             # Method 2. masking with true label, default mode
             else:
                 # self.masked_v = tf.matmul(tf.squeeze(self.caps2), tf.reshape(self.Y, (-1, 10, 1)), transpose_a=True)
-                self.masked_v = tf.multiply(tf.squeeze(self.caps2), tf.reshape(self.Y, (-1, 10, 1)))
+                self.masked_v = tf.multiply(tf.squeeze(self.caps2, axis=3), tf.reshape(self.Y, (-1, 10, 1)))
                 self.v_length = tf.sqrt(tf.reduce_sum(tf.square(self.caps2), axis=2, keep_dims=True) + epsilon)
 
         # 2. Reconstructe the MNIST images with 3 FC layers
         # [batch_size, 1, 16, 1] => [batch_size, 16] => [batch_size, 512]
         with tf.variable_scope('Decoder'):
-            vector_j = tf.reshape(self.masked_v, shape=(cfg.batch_size, -1))
+            vector_j = tf.reshape(self.masked_v, shape=(-1, self.masked_v.get_shape()[1:].num_elements()))
             fc1 = tf.contrib.layers.fully_connected(vector_j, num_outputs=512)
-            assert fc1.get_shape() == [cfg.batch_size, 512]
+            assert fc1.get_shape()[1:] == [512]
             fc2 = tf.contrib.layers.fully_connected(fc1, num_outputs=1024)
-            assert fc2.get_shape() == [cfg.batch_size, 1024]
+            assert fc2.get_shape()[1:] == [1024]
             self.decoded = tf.contrib.layers.fully_connected(fc2, num_outputs=784, activation_fn=tf.sigmoid)
 
+    def export(self, sess, export_dir):
+        '''
+        Exports the graph and the variables of sess as a SavedModel with a
+        predict signature, taking 'images' [batch_size, 28, 28, 1] in [0, 1]
+        and returning the predicted 'classes' and the DigitCaps 'lengths'.
+        The builder adds its own saver ops, so the graph must not be finalized.
+        '''
+        with self.graph.as_default():
+            signature = tf.saved_model.signature_def_utils.predict_signature_def(
+                inputs={'images': self.X},
+                outputs={'classes': self.argmax_idx, 'lengths': self.lengths})
+            builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+            builder.add_meta_graph_and_variables(
+                sess, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={
+                    tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature})
+            builder.save()
+
     def loss(self):
         # 1. The margin loss
 
@@ -109,11 +146,11 @@ class CapsNet(object):
         max_l = tf.square(tf.maximum(0., cfg.m_plus - self.v_length))
         # max_r = max(0, ||v_c||-m_minus)^2
         max_r = tf.square(tf.maximum(0., self.v_length - cfg.m_minus))
-        assert max_l.get_shape() == [cfg.batch_size, 10, 1, 1]
+        assert max_l.get_shape()[1:] == [10, 1, 1]
 
         # reshape: [batch_size, 10, 1, 1] => [batch_size, 10]
-        max_l = tf.reshape(max_l, shape=(cfg.batch_size, -1))
-        max_r = tf.reshape(max_r, shape=(cfg.batch_size, -1))
+        max_l = tf.reshape(max_l, shape=(-1, 10))
+        max_r = tf.reshape(max_r, shape=(-1, 10))
 
         # calc T_c: [batch_size, 10]
         # T_c = Y, is my understanding correct? Try it.
@@ -124,7 +161,7 @@ class CapsNet(object):
         self.margin_loss = tf.reduce_mean(tf.reduce_sum(L_c, axis=1))
 
         # 2. The reconstruction loss
-        orgin = tf.reshape(self.X, shape=(cfg.batch_size, -1))
+        orgin = tf.reshape(self.X, shape=(-1, 784))
         squared = tf.square(self.decoded - orgin)
         self.reconstruction_err = tf.reduce_mean(squared)
 
@@ -141,9 +178,6 @@ class CapsNet(object):
         train_summary.append(tf.summary.scalar('train/margin_loss', self.margin_loss))
         train_summary.append(tf.summary.scalar('train/reconstruction_loss', self.reconstruction_err))
         train_summary.append(tf.summary.scalar('train/total_loss', self.total_loss))
-        recon_img = tf.reshape(self.decoded, shape=(cfg.batch_size, 28, 28, 1))
+        recon_img = tf.reshape(self.decoded, shape=(-1, 28, 28, 1))
         train_summary.append(tf.summary.image('reconstruction_img', recon_img))
         self.train_summary = tf.summary.merge(train_summary)
-
-        correct_prediction = tf.equal(tf.to_int32(self.labels), self.argmax_idx)
-        self.accuracy = tf.reduce_sum(tf.cast(correct_prediction, tf.float32))
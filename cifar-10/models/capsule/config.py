@@ -33,6 +33,7 @@ flags.DEFINE_integer('train_sum_freq', 100, 'the frequency of saving train summa
 flags.DEFINE_integer('val_sum_freq', 500, 'the frequency of saving valuation summary(step)')
 flags.DEFINE_integer('save_freq', 3, 'the frequency of saving model(epoch)')
 flags.DEFINE_string('results', 'results', 'path for saving results')
+flags.DEFINE_string('export_dir', '', 'if set and not training, export the inference graph as a SavedModel to this new directory')
 
 ############################
 #   distributed setting    #
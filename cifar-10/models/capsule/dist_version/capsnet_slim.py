@@ -10,23 +10,23 @@ def build_arch(input, y, is_train=False):
     with slim.arg_scope([slim.conv2d], trainable=is_train, weights_initializer=initializer, biases_initializer=biasInitializer):
         with tf.variable_scope('Conv1_layer') as scope:
             output = slim.conv2d(input, num_outputs=256, kernel_size=[9, 9], stride=1, padding='VALID', scope=scope)
-            assert output.get_shape() == [cfg.batch_size_per_gpu, 20, 20, 256]
+            assert output.get_shape()[1:] == [20, 20, 256]
 
         with tf.variable_scope('PrimaryCaps_layer') as scope:
             output = slim.conv2d(output, num_outputs=32*8, kernel_size=[9, 9], stride=2, padding='VALID', scope=scope, activation_fn=None)
-            output = tf.reshape(output, [cfg.batch_size_per_gpu, -1, 1, 8])
-            assert output.get_shape() == [cfg.batch_size_per_gpu, 1152, 1, 8]
+            output = tf.reshape(output, [-1, 1152, 1, 8])
+            assert output.get_shape()[1:] == [1152, 1, 8]
 
         with tf.variable_scope('DigitCaps_layer') as scope:
-            u_hats = []
-            input_groups = tf.split(axis=1, num_or_size_splits=1152, value=output)
-            for i in range(1152):
-                u_hat = slim.conv2d(input_groups[i], num_outputs=16*10, kernel_size=[1, 1], stride=1, padding='VALID', scope='DigitCaps_layer_w_'+str(i), activation_fn=None)
-                u_hat = tf.reshape(u_hat, [cfg.batch_size_per_gpu, 1, 10, 16])
-                u_hats.append(u_hat)
+            # one [8, 16*10] transform per input capsule, applied to all 1152
+            # capsules with a single batched matmul instead of 1152 1x1 convs
+            weights = slim.model_variable('weights', shape=[1152, 8, 16*10], initializer=initializer, trainable=is_train)
+            biases = slim.model_variable('biases', shape=[1152, 16*10], initializer=biasInitializer, trainable=is_train)
 
-            output = tf.concat(u_hats, axis=1)
-            assert output.get_shape() == [cfg.batch_size_per_gpu, 1152, 10, 16]
+            output = tf.transpose(tf.reshape(output, [-1, 1152, 8]), perm=[1, 0, 2])
+            output = tf.transpose(tf.matmul(output, weights), perm=[1, 0, 2]) + biases
+            output = tf.reshape(output, [-1, 1152, 10, 16])
+            assert output.get_shape()[1:] == [1152, 10, 16]
 
             b_ijs = tf.constant(np.zeros([1152, 10], dtype=np.float32))
             v_js = []
@@ -43,17 +43,17 @@ def build_arch(input, y, is_train=False):
                     for i in range(10):
                         c_ij = tf.reshape(tf.tile(c_ij_groups[i], [1, 16]), [1152, 1, 16, 1])
                         s_j = tf.nn.depthwise_conv2d(input_groups[i], c_ij, strides=[1, 1, 1, 1], padding='VALID')
-                        assert s_j.get_shape() == [cfg.batch_size_per_gpu, 1, 1, 16]
+                        assert s_j.get_shape()[1:] == [1, 1, 16]
 
-                        s_j = tf.reshape(s_j, [cfg.batch_size_per_gpu, 16])
+                        s_j = tf.reshape(s_j, [-1, 16])
                         s_j_norm_square = tf.reduce_mean(tf.square(s_j), axis=1, keep_dims=True)
                         v_j = s_j_norm_square*s_j/((1+s_j_norm_square)*tf.sqrt(s_j_norm_square+1e-9))
-                        assert v_j.get_shape() == [cfg.batch_size_per_gpu, 16]
+                        assert v_j.get_shape()[1:] == [16]
 
-                        b_ij_groups[i] = b_ij_groups[i]+tf.reduce_sum(tf.matmul(tf.reshape(input_groups[i], [cfg.batch_size_per_gpu, 1152, 16]), tf.reshape(v_j, [cfg.batch_size, 16, 1])), axis=0)
+                        b_ij_groups[i] = b_ij_groups[i]+tf.reduce_sum(tf.matmul(tf.reshape(input_groups[i], [-1, 1152, 16]), tf.reshape(v_j, [-1, 16, 1])), axis=0)
 
                         if r_iter == cfg.iter_routing-1:
-                            v_js.append(tf.reshape(v_j, [cfg.batch_size_per_gpu, 1, 16]))
+                            v_js.append(tf.reshape(v_j, [-1, 1, 16]))
 
                     b_ijs = tf.concat(b_ij_groups, axis=1)
 
@@ -81,7 +81,7 @@ def loss(v_len, output, x, y):
 
     margin_loss = tf.reduce_mean(tf.reduce_sum(l_c, axis=1))
 
-    origin = tf.reshape(x, shape=[cfg.batch_size, -1])
+    origin = tf.reshape(x, shape=[-1, 784])
     reconstruction_err = tf.reduce_mean(tf.square(output-origin))
 
     total_loss = margin_loss+0.0005*reconstruction_err
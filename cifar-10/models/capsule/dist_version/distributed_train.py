@@ -4,7 +4,7 @@ sys.path.append('.')
 
 import tensorflow as tf
 from config import cfg
-from utils import load_mnist
+from utils import get_batch_data
 import dist_version.capsnet_slim as net
 import time
 import tensorflow.contrib.slim as slim
@@ -14,17 +14,8 @@ import numpy as np
 import os
 
 def create_inputs():
-    trX, trY = load_mnist(cfg.dataset, cfg.is_training)
-
     num_pre_threads = cfg.thread_per_gpu*cfg.num_gpu
-    data_queue = tf.train.slice_input_producer([trX, trY], capacity=64*num_pre_threads)
-    X, Y = tf.train.shuffle_batch(data_queue, num_threads=num_pre_threads,
-                                  batch_size=cfg.batch_size_per_gpu*cfg.num_gpu,
-                                  capacity=cfg.batch_size_per_gpu*cfg.num_gpu * 64,
-                                  min_after_dequeue=cfg.batch_size_per_gpu*cfg.num_gpu * 32,
-                                  allow_smaller_final_batch=False)
-
-    return (X, Y)
+    return get_batch_data(cfg.dataset, cfg.batch_size_per_gpu*cfg.num_gpu, num_pre_threads)
 
 def tower_loss(x, y, scope, reuse_variables=None):
     with tf.variable_scope(tf.get_variable_scope(), reuse=reuse_variables):
@@ -120,7 +111,6 @@ def main(_):
 
         saver = tf.train.Saver(tf.global_variables(), max_to_keep=cfg.epoch)
         summary_op = tf.summary.merge(summaries)
-        tf.train.start_queue_runners(sess=sess)
 
         summary_writer = tf.summary.FileWriter(
             cfg.logdir,
@@ -5,7 +5,7 @@ import tensorflow as tf
 from tqdm import tqdm
 
 from config import cfg
-from utils import load_data
+from utils import load_data, normalize
 from capsNet import CapsNet
 
 
@@ -73,12 +73,11 @@ def train(model, supervisor, num_label):
 
                 if cfg.val_sum_freq != 0 and (global_step) % cfg.val_sum_freq == 0:
                     val_acc = 0
-                    for i in range(num_val_batch):
-                        start = i * cfg.batch_size
+                    for start in range(0, len(valY), cfg.batch_size):
                         end = start + cfg.batch_size
-                        acc = sess.run(model.accuracy, {model.X: valX[start:end], model.labels: valY[start:end]})
+                        acc = sess.run(model.accuracy, {model.X: normalize(valX[start:end]), model.labels: valY[start:end]})
                         val_acc += acc
-                    val_acc = val_acc / (cfg.batch_size * num_val_batch)
+                    val_acc = val_acc / len(valY)
                     fd_val_acc.write(str(global_step) + ',' + str(val_acc) + '\n')
                     fd_val_acc.flush()
 
@@ -97,24 +96,41 @@ def evaluation(model, supervisor, num_label):
         supervisor.saver.restore(sess, tf.train.latest_checkpoint(cfg.logdir))
         tf.logging.info('Model restored!')
 
+        # the graph takes any batch size, so the last batch holds the remainder
         test_acc = 0
-        for i in tqdm(range(num_te_batch), total=num_te_batch, ncols=70, leave=False, unit='b'):
-            start = i * cfg.batch_size
+        starts = range(0, len(teY), cfg.batch_size)
+        for start in tqdm(starts, total=len(starts), ncols=70, leave=False, unit='b'):
             end = start + cfg.batch_size
-            acc = sess.run(model.accuracy, {model.X: teX[start:end], model.labels: teY[start:end]})
+            acc = sess.run(model.accuracy, {model.X: normalize(teX[start:end]), model.labels: teY[start:end]})
             test_acc += acc
-        test_acc = test_acc / (cfg.batch_size * num_te_batch)
+        test_acc = test_acc / len(teY)
         fd_test_acc.write(str(test_acc))
         fd_test_acc.close()
         print('Test accuracy has been saved to ' + cfg.results + '/test_acc.csv')
 
 
+def export(model):
+    # a Supervisor would finalize the graph, leaving no room for the ops the
+    # SavedModel builder adds, so restore with a plain saver and session
+    with model.graph.as_default():
+        saver = tf.train.Saver()
+    with tf.Session(graph=model.graph, config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        saver.restore(sess, tf.train.latest_checkpoint(cfg.logdir))
+        tf.logging.info('Model restored!')
+        model.export(sess, cfg.export_dir)
+        print('SavedModel has been exported to ' + cfg.export_dir)
+
+
 def main(_):
     tf.logging.info(' Loading Graph...')
     num_label = 10
-    model = CapsNet()
+    model = CapsNet(is_training=cfg.is_training)
     tf.logging.info(' Graph loaded')
 
+    if not cfg.is_training and cfg.export_dir:
+        export(model)
+        return
+
     sv = tf.train.Supervisor(graph=model.graph, logdir=cfg.logdir, save_model_secs=0)
 
     if cfg.is_training:
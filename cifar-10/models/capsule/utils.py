@@ -1,24 +1,42 @@
 import os
+import struct
 import scipy
 import numpy as np
 import tensorflow as tf
 
 
-def load_mnist(batch_size, is_training=True):
-    path = os.path.join('data', 'mnist')
-    if is_training:
-        fd = open(os.path.join(path, 'train-images-idx3-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        trainX = loaded[16:].reshape((60000, 28, 28, 1)).astype(np.float32)
+def load_idx(filename):
+    '''
+    Memory maps an IDX file as a read-only uint8 array, without copying it.
 
-        fd = open(os.path.join(path, 'train-labels-idx1-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        trainY = loaded[8:].reshape((60000)).astype(np.int32)
+    Args:
+        filename: path of an uncompressed IDX file of unsigned bytes
+    Returns:
+        a numpy memmap of the shape declared in the file header
+    '''
+    with open(filename, 'rb') as fd:
+        zeros, dtype, ndim = struct.unpack('>HBB', fd.read(4))
+        if zeros != 0 or dtype != 0x08:
+            raise ValueError('Not an IDX file of unsigned bytes: ' + filename)
+        shape = struct.unpack('>' + 'I' * ndim, fd.read(4 * ndim))
+    return np.memmap(filename, dtype=np.uint8, mode='r', offset=4 + 4 * ndim, shape=shape)
 
-        trX = trainX[:55000] / 255.
+
+def load_idx_dataset(name, batch_size, is_training=True):
+    '''
+    Loads an MNIST-like dataset from data/<name> as uint8 views.
+    The images are [num_examples, 28, 28, 1] memmaps and are not normalized,
+    see normalize.
+    '''
+    path = os.path.join('data', name)
+    if is_training:
+        trainX = load_idx(os.path.join(path, 'train-images-idx3-ubyte')).reshape((-1, 28, 28, 1))
+        trainY = load_idx(os.path.join(path, 'train-labels-idx1-ubyte'))
+
+        trX = trainX[:55000]
         trY = trainY[:55000]
 
-        valX = trainX[55000:, ] / 255.
+        valX = trainX[55000:, ]
         valY = trainY[55000:]
 
         num_tr_batch = 55000 // batch_size
@@ -26,50 +44,24 @@ def load_mnist(batch_size, is_training=True):
 
         return trX, trY, num_tr_batch, valX, valY, num_val_batch
     else:
-        fd = open(os.path.join(path, 't10k-images-idx3-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        teX = loaded[16:].reshape((10000, 28, 28, 1)).astype(np.float)
-
-        fd = open(os.path.join(path, 't10k-labels-idx1-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        teY = loaded[8:].reshape((10000)).astype(np.int32)
+        teX = load_idx(os.path.join(path, 't10k-images-idx3-ubyte')).reshape((-1, 28, 28, 1))
+        teY = load_idx(os.path.join(path, 't10k-labels-idx1-ubyte'))
 
         num_te_batch = 10000 // batch_size
-        return teX / 255., teY, num_te_batch
-
-
-def load_fashion_mnist(batch_size, is_training=True):
-    path = os.path.join('data', 'fashion-mnist')
-    if is_training:
-        fd = open(os.path.join(path, 'train-images-idx3-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        trainX = loaded[16:].reshape((60000, 28, 28, 1)).astype(np.float32)
+        return teX, teY, num_te_batch
 
-        fd = open(os.path.join(path, 'train-labels-idx1-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        trainY = loaded[8:].reshape((60000)).astype(np.int32)
-
-        trX = trainX[:55000] / 255.
-        trY = trainY[:55000]
 
-        valX = trainX[55000:, ] / 255.
-        valY = trainY[55000:]
+def load_mnist(batch_size, is_training=True):
+    return load_idx_dataset('mnist', batch_size, is_training)
 
-        num_tr_batch = 55000 // batch_size
-        num_val_batch = 5000 // batch_size
 
-        return trX, trY, num_tr_batch, valX, valY, num_val_batch
-    else:
-        fd = open(os.path.join(path, 't10k-images-idx3-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        teX = loaded[16:].reshape((10000, 28, 28, 1)).astype(np.float)
+def load_fashion_mnist(batch_size, is_training=True):
+    return load_idx_dataset('fashion-mnist', batch_size, is_training)
 
-        fd = open(os.path.join(path, 't10k-labels-idx1-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        teY = loaded[8:].reshape((10000)).astype(np.int32)
 
-        num_te_batch = 10000 // batch_size
-        return teX / 255., teY, num_te_batch
+def normalize(images):
+    '''Converts a batch of uint8 images to float32 in [0, 1].'''
+    return np.asarray(images, dtype=np.float32) / 255.
 
 
 def load_data(dataset, batch_size, is_training=True, one_hot=False):
@@ -82,18 +74,38 @@ def load_data(dataset, batch_size, is_training=True, one_hot=False):
 
 
 def get_batch_data(dataset, batch_size, num_threads):
-    if dataset == 'mnist':
-        trX, trY, num_tr_batch, valX, valY, num_val_batch = load_mnist(batch_size, is_training=True)
-    elif dataset == 'fashion-mnist':
-        trX, trY, num_tr_batch, valX, valY, num_val_batch = load_fashion_mnist(batch_size, is_training=True)
-    data_queues = tf.train.slice_input_producer([trX, trY])
-    X, Y = tf.train.shuffle_batch(data_queues, num_threads=num_threads,
-                                  batch_size=batch_size,
-                                  capacity=batch_size * 64,
-                                  min_after_dequeue=batch_size * 32,
-                                  allow_smaller_final_batch=False)
-
-    return(X, Y)
+    trX, trY, num_tr_batch, valX, valY, num_val_batch = load_data(dataset, batch_size, is_training=True)
+    return make_batch(trX, trY, batch_size, num_threads)
+
+
+def make_batch(X, Y, batch_size, num_threads, shuffle=True):
+    '''
+    Returns the next (images, labels) batch of an endless tf.data pipeline.
+    Only indices go through the graph: batches of shuffled indices are
+    gathered from the arrays X and Y by a py_func, so the arrays are never
+    embedded as graph constants.
+
+    Args:
+        X: uint8 images array, [num_examples, 28, 28, 1], normalized per batch
+        Y: labels array, [num_examples]
+        num_threads: number of threads gathering batches
+    '''
+    def gather(indices):
+        return normalize(X[indices]), Y[indices].astype(np.int32)
+
+    def load_batch(indices):
+        images, labels = tf.py_func(gather, [indices], [tf.float32, tf.int32], stateful=False)
+        images.set_shape((None, ) + X.shape[1:])
+        labels.set_shape((None, ))
+        return images, labels
+
+    dataset = tf.contrib.data.Dataset.range(len(Y))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=len(Y))
+    dataset = dataset.repeat().batch(batch_size)
+    dataset = dataset.map(load_batch, num_threads=num_threads, output_buffer_size=2 * num_threads)
+    dataset = dataset.prefetch(1)
+    return(dataset.make_one_shot_iterator().get_next())
 
 
 def save_images(imgs, size, path):
@@ -0,0 +1,209 @@
+"""Benchmark of the CIFAR-10 input pipeline, without the model.
+Drains Cifar10DataSet.make_batch for a fixed number of batches under every
+combination of the swept settings, and writes the images/sec and per-batch
+latency percentiles of each run to a JSON report. Cached runs first drain a
+full epoch, so that only reads from the completed cache are measured, and
+every file-cached run uses a fresh directory under the given one, e.g.
+
+  python benchmark_input.py --data-dir=${PWD}/cifar-10-data \
+      --record-format tfrecord array --batch-size 128 256 \
+      --cache none memory --output input_benchmark.json
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import math
+import shutil
+import tempfile
+import time
+
+import cifar10
+import numpy as np
+import tensorflow as tf
+
+PERCENTILES = (50, 90, 99)
+
+
+def benchmark(data_dir, subset, batch_size, num_batches, warmup_batches,
+              **dataset_kwargs):
+  """Drains one input pipeline and returns its throughput and latencies.
+  The first `warmup_batches` batches fill the shuffle buffers, caches and
+  threads and are not measured. A cache is only complete after one epoch, so
+  cached runs warm up for at least an epoch.
+  """
+  if dataset_kwargs.get('cache'):
+    epoch_batches = int(math.ceil(cifar10.Cifar10DataSet.num_examples_per_epoch(
+        subset, data_dir) / batch_size))
+    warmup_batches = max(warmup_batches, epoch_batches)
+
+  with tf.Graph().as_default():
+    dataset = cifar10.Cifar10DataSet(data_dir, subset, subset == 'train',
+                                     **dataset_kwargs)
+    image_batch, _ = dataset.make_batch(batch_size)
+    # Only the batch size is fetched, so that copying the images out of the
+    # session is not measured.
+    num_images = tf.shape(image_batch)[0]
+
+    with tf.Session() as sess:
+      for _ in range(warmup_batches):
+        sess.run(num_images)
+
+      latencies = []
+      total_images = 0
+      start = time.time()
+      for _ in range(num_batches):
+        batch_start = time.time()
+        total_images += sess.run(num_images)
+        latencies.append(time.time() - batch_start)
+      elapsed = time.time() - start
+
+  latencies = np.array(latencies) * 1000
+  latency_ms = {'p%d' % p: float(np.percentile(latencies, p))
+                for p in PERCENTILES}
+  latency_ms['mean'] = float(latencies.mean())
+  latency_ms['max'] = float(latencies.max())
+  return {
+      'images_per_sec': total_images / elapsed,
+      'num_images': int(total_images),
+      'warmup_batches': warmup_batches,
+      'latency_ms': latency_ms,
+  }
+
+
+def sweep(settings):
+  """Yields every combination of the swept settings as a dict.
+  Combinations the array format ignores, i.e. batch parsing and caching, are
+  skipped.
+  """
+  names = sorted(settings)
+  for values in itertools.product(*(settings[name] for name in names)):
+    combination = dict(zip(names, values))
+    if combination['record_format'] == 'array' and (
+        combination['batch_parse'] or combination['cache']):
+      continue
+    yield combination
+
+
+def _parse_optional(value, type_=str):
+  """Parses a flag value where 'none' stands for the default."""
+  return None if value.lower() == 'none' else type_(value)
+
+
+def main(data_dir, subset, num_batches, warmup_batches, output, **settings):
+  results = []
+  for combination in sweep(settings):
+    dataset_kwargs = dict(combination)
+    cache_dir = None
+    if combination['cache'] not in (None, 'memory'):
+      # A cache left by another run would be replayed or locked, so every run
+      # writes its own.
+      if not tf.gfile.Exists(combination['cache']):
+        tf.gfile.MakeDirs(combination['cache'])
+      cache_dir = tempfile.mkdtemp(dir=combination['cache'])
+      dataset_kwargs['cache'] = cache_dir
+    try:
+      result = benchmark(data_dir, subset, num_batches=num_batches,
+                         warmup_batches=warmup_batches, **dataset_kwargs)
+    finally:
+      if cache_dir:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    result['settings'] = combination
+    results.append(result)
+    print('%s: %.1f images/sec, p50 %.2f ms, p99 %.2f ms' %
+          (json.dumps(combination, sort_keys=True), result['images_per_sec'],
+           result['latency_ms']['p50'], result['latency_ms']['p99']))
+
+  report = {
+      'data_dir': data_dir,
+      'subset': subset,
+      'num_batches': num_batches,
+      'warmup_batches': warmup_batches,
+      'results': results,
+  }
+  with open(output, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  print('Report written to %s' % output)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--data-dir',
+      type=str,
+      required=True,
+      help='The directory where the CIFAR-10 input data is stored.')
+  parser.add_argument(
+      '--subset',
+      choices=['train', 'validation', 'eval'],
+      default='train',
+      help='Subset to read, distortions are only applied to train.')
+  parser.add_argument(
+      '--num-batches',
+      type=int,
+      default=200,
+      help='Number of batches measured for every combination.')
+  parser.add_argument(
+      '--warmup-batches',
+      type=int,
+      default=20,
+      help='Number of batches read before measuring.')
+  parser.add_argument(
+      '--output',
+      type=str,
+      default='input_benchmark.json',
+      help='Path of the JSON report.')
+  parser.add_argument(
+      '--record-format',
+      nargs='+',
+      choices=['tfrecord', 'array'],
+      default=['tfrecord'],
+      help='Record formats to sweep.')
+  parser.add_argument(
+      '--batch-parse',
+      nargs='+',
+      type=lambda value: value.lower() == 'true',
+      default=[False],
+      help='Whether to parse whole batches of records, e.g. false true.')
+  parser.add_argument(
+      '--batch-size',
+      nargs='+',
+      type=int,
+      default=[128],
+      help='Batch sizes to sweep.')
+  parser.add_argument(
+      '--map-threads',
+      nargs='+',
+      type=lambda value: _parse_optional(value, int),
+      default=[None],
+      help="""\
+      Parsing or loading threads to sweep, 'none' for the dataset default.\
+      """)
+  parser.add_argument(
+      '--shuffle-buffer',
+      nargs='+',
+      type=lambda value: _parse_optional(value, int),
+      default=[None],
+      help="""\
+      Training shuffle buffer sizes to sweep, 'none' for the dataset
+      default.\
+      """)
+  parser.add_argument(
+      '--cache',
+      nargs='+',
+      type=_parse_optional,
+      default=[None],
+      help="""\
+      Caches to sweep: 'none', 'memory' or a directory under which every run
+      writes a fresh file cache.\
+      """)
+  parser.add_argument(
+      '--prefetch-batches',
+      nargs='+',
+      type=int,
+      default=[1],
+      help='Prefetch depths to sweep.')
+  args = parser.parse_args()
+  main(**vars(args))
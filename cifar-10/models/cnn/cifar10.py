@@ -14,11 +14,17 @@
 # ==============================================================================
 """CIFAR-10 data set.
 See http://www.cs.toronto.edu/~kriz/cifar.html.
+Requires TensorFlow 1.5+, the TFRecord shards are read with
+tf.contrib.data.parallel_interleave.
 """
 import os
 
+import numpy as np
 import tensorflow as tf
 
+import occlusion
+import tfrecord_index
+
 HEIGHT = 32
 WIDTH = 32
 DEPTH = 3
@@ -28,19 +34,82 @@ class Cifar10DataSet(object):
   Described by http://www.cs.toronto.edu/~kriz/cifar.html.
   """
 
-  def __init__(self, data_dir, subset='train', use_distortion=True):
+  def __init__(self, data_dir, subset='train', use_distortion=True,
+               censor_patch_size=0, censor_stride=2, censor_selection=None,
+               cycle_length=4, block_length=1, record_format='tfrecord',
+               batch_parse=False, cache=None, prefetch_batches=1,
+               num_workers=1, worker_index=0, map_threads=None,
+               shuffle_buffer=None):
+    """Cifar10DataSet constructor.
+    Args:
+      data_dir: directory where the TFRecords of the subsets are located.
+      subset: one of 'train', 'validation' and 'eval'.
+      use_distortion: True to distort the training images.
+      censor_patch_size: if positive, every record is expanded into itself
+        followed by its occluded variants, see occlusion.occlusion_masks.
+      censor_stride: distance between two neighbouring occlusion windows.
+      censor_selection: optional bool array of shape [num_records,
+        num_variants] keeping only the selected variants of every record.
+      cycle_length: number of training shards read in parallel.
+      block_length: number of consecutive records read from one training
+        shard before moving to the next one.
+      record_format: 'tfrecord' to parse the TFRecord files, or 'array' to
+        slice batches out of the memory-mapped <subset>_images.npy and
+        <subset>_labels.npy arrays written by generate_cifar10_tfrecords.py.
+      batch_parse: if True, batch the serialized TFRecords first and parse,
+        decode and convert whole batches at once.
+      cache: if set, keep the decoded uint8 TFRecord images, before any
+        augmentation. 'memory' reads the whole subset into arrays once and
+        shuffles indices over them, anything else is a directory where the
+        decoded images are cached to a file.
+      prefetch_batches: number of batches prepared ahead of the model.
+      num_workers: number of replicas splitting the subset among them.
+      worker_index: index of the replica, each replica only reads its own
+        disjoint slice of the subset.
+      map_threads: number of threads parsing records or loading batches,
+        defaults to the batch size for per-record parsing and to 4 otherwise.
+      shuffle_buffer: number of training records, or indices, buffered for
+        shuffling. Defaults to 40% of the records, or to all the indices.
+    """
+    if record_format not in ('tfrecord', 'array'):
+      raise ValueError('Invalid record format "%s"' % record_format)
+    if not 0 <= worker_index < num_workers:
+      raise ValueError('Invalid worker index %d of %d workers' %
+                       (worker_index, num_workers))
     self.data_dir = data_dir
     self.subset = subset
     self.use_distortion = use_distortion
+    self.censor_patch_size = censor_patch_size
+    self.censor_stride = censor_stride
+    self.censor_selection = censor_selection
+    self.cycle_length = cycle_length
+    self.block_length = block_length
+    self.record_format = record_format
+    self.batch_parse = batch_parse
+    self.cache = cache
+    self.prefetch_batches = prefetch_batches
+    self.num_workers = num_workers
+    self.worker_index = worker_index
+    self.map_threads = map_threads
+    self.shuffle_buffer = shuffle_buffer
 
   def get_filenames(self):
+    """Returns the TFRecord files of the subset, in record order.
+    Picks up both the single <subset>.tfrecords file and the shards written
+    by generate_cifar10_tfrecords.py --num-shards.
+    """
     if self.subset in ['train', 'validation', 'eval']:
-      return [os.path.join(self.data_dir, self.subset + '.tfrecords')]
+      filenames = sorted(
+          tf.gfile.Glob(os.path.join(self.data_dir, self.subset + '.tfrecords'))
+          + tf.gfile.Glob(
+              os.path.join(self.data_dir, self.subset + '-*-of-*.tfrecords')))
+      return filenames or [os.path.join(self.data_dir,
+                                        self.subset + '.tfrecords')]
     else:
       raise ValueError('Invalid data subset "%s"' % self.subset)
 
   def parser(self, serialized_example):
-    """Parses a single tf.Example into image and label tensors."""
+    """Parses a single tf.Example into uint8 image and label tensors."""
     # Dimensions of the images in the CIFAR-10 dataset.
     # See http://www.cs.toronto.edu/~kriz/cifar.html for a description of the
     # input format.
@@ -54,61 +123,340 @@ class Cifar10DataSet(object):
     image.set_shape([DEPTH * HEIGHT * WIDTH])
 
     # Reshape from [depth * height * width] to [depth, height, width].
-    image = tf.cast(
-        tf.transpose(tf.reshape(image, [DEPTH, HEIGHT, WIDTH]), [1, 2, 0]),
-        tf.float32)
+    image = tf.transpose(tf.reshape(image, [DEPTH, HEIGHT, WIDTH]), [1, 2, 0])
     label = tf.cast(features['label'], tf.int32)
 
-    # Custom preprocessing.
-    image = self.preprocess(image)
-
     return image, label
 
+  def parse_batch(self, serialized_examples):
+    """Parses a batch of tf.Examples into uint8 image and label batches."""
+    features = tf.parse_example(
+        serialized_examples,
+        features={
+            'image': tf.FixedLenFeature([], tf.string),
+            'label': tf.FixedLenFeature([], tf.int64),
+        })
+    images = tf.decode_raw(features['image'], tf.uint8)
+    images.set_shape([None, DEPTH * HEIGHT * WIDTH])
+
+    # Reshape from [batch, depth * height * width] to
+    # [batch, height, width, depth].
+    images = tf.transpose(tf.reshape(images, [-1, DEPTH, HEIGHT, WIDTH]),
+                          [0, 2, 3, 1])
+    labels = tf.cast(features['label'], tf.int32)
+
+    return images, labels
+
   def make_batch(self, batch_size):
     # batch_size = 1
 
     """Read the images and labels from 'filenames'."""
+    if self.record_format == 'array':
+      images, labels = self.load_arrays()
+      dataset = self.index_batches(images, labels, batch_size)
+    elif self.cache == 'memory':
+      images, labels = self.read_arrays()
+      dataset = self.index_batches(images, labels, batch_size)
+    else:
+      dataset = self.record_batches(batch_size)
+
+    # Expand every image into its occluded variants.
+    if self.censor_patch_size > 0:
+      dataset = dataset.apply(tf.contrib.data.unbatch())
+      dataset = self.censor(dataset).batch(batch_size)
+
+    # Custom preprocessing.
+    dataset = dataset.map(
+        lambda images, labels: (
+            self.preprocess_batch(tf.cast(images, tf.float32)), labels))
+
+    # Overlap the input pipeline with the model.
+    if self.prefetch_batches > 0:
+      dataset = dataset.prefetch(self.prefetch_batches)
+
+    iterator = dataset.make_one_shot_iterator()
+    image_batch, label_batch = iterator.get_next()
+
+    return image_batch, label_batch
+
+  def get_record_ranges(self):
+    """Returns the (filename, start, count) record ranges of this worker.
+    Whole files are dealt out to the workers when there are at least as many
+    files as workers, else the records are split using the index sidecars
+    and every range is read from its byte offset. A count of -1 reads the
+    whole file.
+    """
     filenames = self.get_filenames()
+    if self.num_workers == 1:
+      return [(filename, 0, -1) for filename in filenames]
+    if len(filenames) >= self.num_workers:
+      return [(filename, 0, -1)
+              for filename in filenames[self.worker_index::self.num_workers]]
+    if not all(tfrecord_index.has_index(f) for f in filenames):
+      raise ValueError(
+          'Splitting %d TFRecord files among %d workers requires their index '
+          'sidecars, see generate_cifar10_tfrecords.py' %
+          (len(filenames), self.num_workers))
+    return [(filename, start, end - start)
+            for filename, start, end in tfrecord_index.split_records(
+                filenames, self.num_workers, self.worker_index)]
+
+  @staticmethod
+  def read_file(filename, start, count):
+    """Returns a dataset of all the records of a file."""
+    return tf.contrib.data.TFRecordDataset(filename)
+
+  @staticmethod
+  def read_range(filename, start, count):
+    """Returns a dataset of `count` records of a file from record `start`.
+    The range is read from its first byte offset in the index sidecar, so
+    the records of the other workers are not read.
+    """
+    def read(filename, start, count):
+      return np.array(tfrecord_index.read_records(
+          tf.compat.as_str_any(filename), start, start + count), dtype=object)
+
+    records = tf.py_func(read, [filename, start, count], tf.string,
+                         stateful=False)
+    records.set_shape([None])
+    return tf.contrib.data.Dataset.from_tensor_slices(records)
+
+  def read_records(self, repeat=True):
+    """Returns a dataset of the serialized records of this worker."""
+    filenames, starts, counts = zip(*self.get_record_ranges())
     # filenames = tf.Print(filenames, [filenames], message="############################: ")
+    if all(count < 0 for count in counts):
+      read = self.read_file
+    else:
+      read = self.read_range
 
-    # Repeat infinitely.
-    dataset = tf.contrib.data.TFRecordDataset(filenames).repeat()
+    dataset = tf.contrib.data.Dataset.from_tensor_slices(
+        (list(filenames), np.array(starts, dtype=np.int64),
+         np.array(counts, dtype=np.int64)))
+    if self.subset == 'train':
+      # Shuffle the shards, then read several of them in parallel. Only one
+      # pass is interleaved, else a file would be read by several of the
+      # parallel readers at once and its records repeated back to back.
+      dataset = dataset.shuffle(buffer_size=len(filenames))
+      dataset = dataset.apply(
+          tf.contrib.data.parallel_interleave(
+              read,
+              cycle_length=self.cycle_length,
+              block_length=self.block_length))
+    else:
+      # Keep the record order, the censor outputs are indexed by it.
+      dataset = dataset.flat_map(read)
+    if repeat:
+      dataset = dataset.repeat()
+    return dataset
 
-    # Parse records.
-    dataset = dataset.map(
-        self.parser, num_threads=batch_size, output_buffer_size=2 * batch_size)
+  def record_batches(self, batch_size):
+    """Returns a dataset of uint8 image and label batches from the TFRecords.
+    When caching, the decoded images of the first pass are cached and
+    replayed for the following ones.
+    """
+    # Repeat infinitely, after the cache if any.
+    dataset = self.read_records(repeat=self.cache is None)
+
+    if self.batch_parse:
+      # Shuffle the serialized records, then parse whole batches.
+      if self.cache is None:
+        dataset = self.shuffle(dataset, batch_size)
+      dataset = dataset.batch(batch_size)
+      dataset = dataset.map(self.parse_batch,
+                            num_threads=self.map_threads or 4,
+                            output_buffer_size=2)
+      if self.cache is None:
+        return dataset
+      dataset = dataset.apply(tf.contrib.data.unbatch())
+    else:
+      # Parse records.
+      dataset = dataset.map(
+          self.parser, num_threads=self.map_threads or batch_size,
+          output_buffer_size=2 * batch_size)
+
+    if self.cache is not None:
+      dataset = self.cache_images(dataset).repeat()
 
-    # Potentially shuffle records.
+    dataset = self.shuffle(dataset, batch_size)
+
+    # Batch it up.
+    return dataset.batch(batch_size)
+
+  def cache_images(self, dataset):
+    """Caches the decoded images in <cache>/<subset>.cache.
+    Every worker caches its own part of the records, so with several workers
+    the cache is <cache>/<subset>-<worker>-of-<workers>.cache.
+    """
+    prefix = self.subset
+    if self.num_workers > 1:
+      prefix = '%s-%05d-of-%05d' % (self.subset, self.worker_index,
+                                    self.num_workers)
+    return dataset.cache(os.path.join(self.cache, prefix + '.cache'))
+
+  def shuffle(self, dataset, batch_size):
+    """Potentially shuffle records.
+    The buffer only ever holds serialized records or uint8 images, augmented
+    float32 images are never buffered.
+    """
     if self.subset == 'train':
-      min_queue_examples = int(
-          Cifar10DataSet.num_examples_per_epoch(self.subset) * 0.4)
+      if self.shuffle_buffer:
+        return dataset.shuffle(buffer_size=self.shuffle_buffer)
+      min_queue_examples = int(Cifar10DataSet.num_examples_per_epoch(
+          self.subset, self.data_dir) * 0.4 / self.num_workers)
       # Ensure that the capacity is sufficiently large to provide good random
       # shuffling.
       dataset = dataset.shuffle(buffer_size=min_queue_examples + 3 * batch_size)
+    return dataset
 
-    # Batch it up.
-    dataset = dataset.batch(batch_size)
-    iterator = dataset.make_one_shot_iterator()
-    image_batch, label_batch = iterator.get_next()
+  def get_array_filenames(self):
+    """Returns the packed images and labels arrays of the subset."""
+    if self.subset in ['train', 'validation', 'eval']:
+      return (os.path.join(self.data_dir, self.subset + '_images.npy'),
+              os.path.join(self.data_dir, self.subset + '_labels.npy'))
+    else:
+      raise ValueError('Invalid data subset "%s"' % self.subset)
 
-    return image_batch, label_batch
+  def load_arrays(self):
+    """Memory maps the slice of the packed arrays read by this worker.
+    Memory mapping lets every process on a host share the page cache, so
+    this format needs no cache.
+    """
+    images_file, labels_file = self.get_array_filenames()
+    images = np.load(images_file, mmap_mode='r')
+    labels = np.load(labels_file, mmap_mode='r')
+    start = self.worker_index * len(labels) // self.num_workers
+    end = (self.worker_index + 1) * len(labels) // self.num_workers
+    return images[start:end], labels[start:end]
+
+  def read_arrays(self):
+    """Reads the records of this worker into uint8 images and int32 labels."""
+    images = []
+    labels = []
+    for filename, start, count in self.get_record_ranges():
+      if count < 0:
+        records = tf.python_io.tf_record_iterator(filename)
+      else:
+        records = tfrecord_index.read_records(filename, start, start + count)
+      for record in records:
+        feature = tf.train.Example.FromString(record).features.feature
+        images.append(np.frombuffer(feature['image'].bytes_list.value[0],
+                                    dtype=np.uint8))
+        labels.append(feature['label'].int64_list.value[0])
+    images = np.stack(images).reshape(-1, DEPTH, HEIGHT, WIDTH)
+    return (np.ascontiguousarray(images.transpose(0, 2, 3, 1)),
+            np.array(labels, dtype=np.int32))
+
+  def index_batches(self, images, labels, batch_size):
+    """Returns a dataset of batches gathered from in-memory or mapped arrays.
+    No record is parsed: a batch of indices is turned into a batch of uint8
+    images with one gather, or one slice when the indices are contiguous.
+    Shuffling permutes indices only, so the shuffle buffer holds 8 bytes per
+    example instead of an image.
+    """
+    def gather(indices):
+      if np.all(np.diff(indices) == 1):
+        indices = slice(indices[0], indices[-1] + 1)
+      return images[indices], labels[indices].astype(np.int32)
+
+    def load_batch(indices):
+      image_batch, label_batch = tf.py_func(
+          gather, [indices], [tf.uint8, tf.int32], stateful=False)
+      image_batch.set_shape([None, HEIGHT, WIDTH, DEPTH])
+      label_batch.set_shape([None])
+      return image_batch, label_batch
+
+    dataset = tf.contrib.data.Dataset.range(len(labels))
+    if self.subset == 'train':
+      # Shuffle indices, not images, over the whole subset.
+      dataset = dataset.shuffle(buffer_size=self.shuffle_buffer or len(labels))
+    dataset = dataset.repeat().batch(batch_size)
+    return dataset.map(load_batch, num_threads=self.map_threads or 4,
+                       output_buffer_size=2)
 
-  def preprocess(self, image):
-    """Preprocess a single image in [height, width, depth] layout."""
+  def censor(self, dataset):
+    """Expands every image of the dataset into its occluded variants."""
+    if self.censor_selection is None:
+      return dataset.flat_map(self.occlude)
+    selection = tf.contrib.data.Dataset.from_tensor_slices(
+        self.censor_selection).repeat()
+    dataset = tf.contrib.data.Dataset.zip((dataset, selection))
+    return dataset.flat_map(
+        lambda example, selected: self.occlude(*example, selected=selected))
+
+  def preprocess_batch(self, images):
+    """Preprocess a batch of images in [batch, height, width, depth] layout.
+    Every image is padded to 40x40, randomly cropped back to 32x32 and
+    randomly flipped left to right, with offsets and flips drawn per image.
+    Crop and flip are applied to the whole batch with a single gather.
+    """
     if self.subset == 'train' and self.use_distortion:
       # Pad 4 pixels on each dimension of feature map, done in mini-batch
-      image = tf.image.resize_image_with_crop_or_pad(image, 40, 40)
-      image = tf.random_crop(image, [HEIGHT, WIDTH, DEPTH])
-      image = tf.image.random_flip_left_right(image)
-    return image
+      padded = tf.pad(images, [[0, 0], [4, 4], [4, 4], [0, 0]])
+      padded_height = HEIGHT + 8
+      padded_width = WIDTH + 8
+      batch_size = tf.shape(images)[0]
+
+      # Top left corner of every crop and whether to flip it.
+      offset_y = tf.random_uniform(
+          [batch_size, 1, 1], 0, padded_height - HEIGHT + 1, dtype=tf.int32)
+      offset_x = tf.random_uniform(
+          [batch_size, 1, 1], 0, padded_width - WIDTH + 1, dtype=tf.int32)
+      flip = tf.cast(tf.random_uniform([batch_size, 1, 1]) < 0.5, tf.int32)
+
+      # Pixel of the padded batch read by every output pixel.
+      rows = tf.reshape(tf.range(HEIGHT), [1, HEIGHT, 1]) + offset_y
+      cols = tf.reshape(tf.range(WIDTH), [1, 1, WIDTH])
+      cols = cols + flip * (WIDTH - 1 - 2 * cols) + offset_x
+      batch = tf.reshape(tf.range(batch_size), [-1, 1, 1])
+      indices = (batch * padded_height + rows) * padded_width + cols
+
+      images = tf.gather(tf.reshape(padded, [-1, DEPTH]), indices)
+    return images
+
+  def occlude(self, image, label, selected=None):
+    """Returns a dataset of the image followed by its occluded variants.
+    If given, the bool vector `selected` keeps only some of the variants.
+    """
+    masks = occlusion.occlusion_masks(self.censor_patch_size,
+                                      self.censor_stride, HEIGHT, WIDTH)
+    masks = tf.constant(masks[..., None], dtype=image.dtype)
+    images = tf.expand_dims(image, 0) * masks
+    labels = tf.fill([self.num_variants()], label)
+    if selected is not None:
+      images = tf.boolean_mask(images, selected)
+      labels = tf.boolean_mask(labels, selected)
+    return tf.contrib.data.Dataset.from_tensor_slices((images, labels))
+
+  def num_variants(self):
+    """Returns the number of examples produced from every record."""
+    if self.censor_patch_size > 0:
+      return occlusion.num_windows(self.censor_patch_size, self.censor_stride,
+                                   HEIGHT, WIDTH) + 1
+    return 1
+
+  def num_examples(self):
+    """Returns the number of examples in one pass over the subset."""
+    if self.censor_patch_size > 0 and self.censor_selection is not None:
+      return int(self.censor_selection.sum())
+    return (Cifar10DataSet.num_examples_per_epoch(self.subset, self.data_dir) *
+            self.num_variants())
 
   @staticmethod
-  def num_examples_per_epoch(subset='train'):
+  def num_examples_per_epoch(subset='train', data_dir=None):
+    """Returns the number of records of the subset.
+    Counted from the index sidecars of the TFRecord files in data_dir when
+    they all have one, else the size of the standard split.
+    """
+    if data_dir is not None:
+      filenames = Cifar10DataSet(data_dir, subset).get_filenames()
+      if all(tfrecord_index.has_index(f) for f in filenames):
+        return sum(tfrecord_index.num_records(f) for f in filenames)
     if subset == 'train':
       return 45000
     elif subset == 'validation':
       return 5000
     elif subset == 'eval':
-      return 13 * 13 + 1 # 10000
+      return 10000
     else:
       raise ValueError('Invalid data subset "%s"' % subset)
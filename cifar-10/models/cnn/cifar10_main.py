@@ -32,15 +32,21 @@ import cifar10
 import cifar10_model
 import cifar10_utils
 import numpy as np
+import occlusion
 import six
-from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
-def get_model_fn(num_gpus, variable_strategy, num_workers):
-  """Returns a function that will build the resnet model."""
+def get_model_fn(num_gpus, variable_strategy, num_workers,
+                 num_train_examples=None):
+  """Returns a function that will build the resnet model.
+  num_train_examples sizes the learning rate schedule, it defaults to the
+  size of the standard training split.
+  """
+  if num_train_examples is None:
+    num_train_examples = cifar10.Cifar10DataSet.num_examples_per_epoch('train')
 
   def _resnet_model_fn(features, labels, mode, params):
     """Resnet model body.
@@ -52,7 +58,7 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
     Args:
       features: a list of tensors, one for each tower
       labels: a list of tensors, one for each tower
-      mode: ModeKeys.TRAIN or EVAL
+      mode: ModeKeys.TRAIN, EVAL or PREDICT
       params: Hyperparameters suitable for tuning
     Returns:
       A EstimatorSpec object.
@@ -61,11 +67,14 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
     weight_decay = params.weight_decay
     momentum = params.momentum
 
-    tower_features = features
-    tower_labels = labels
+    tower_features = list(features)
+    tower_labels = list(labels or [None] * len(features))
     tower_losses = []
     tower_gradvars = []
     tower_preds = []
+    stage_ops = []
+    stage_inputs = (params.stage_inputs and
+                    mode != tf.estimator.ModeKeys.PREDICT)
 
     # channels first (NCHW) is normally optimal on GPU and channels last (NHWC)
     # on CPU. The exception is Intel MKL on CPU which is optimal with
@@ -97,6 +106,13 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
                 num_gpus, tf.contrib.training.byte_size_load_fn))
       with tf.variable_scope('resnet', reuse=bool(i != 0)):
         with tf.name_scope('tower_%d' % i) as name_scope:
+          if stage_inputs:
+            # Copy the next shard to the tower device while this step runs.
+            with tf.device(worker_device):
+              staged, put_op = cifar10_utils.stage(
+                  [tower_features[i], tower_labels[i]])
+              tower_features[i], tower_labels[i] = staged
+              stage_ops.append(put_op)
           with tf.device(device_setter):
             loss, gradvars, preds = _tower_fn(
                 is_training, weight_decay, tower_features[i], tower_labels[i],
@@ -114,6 +130,19 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
               update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS,
                                              name_scope)
 
+    # Device that runs the ops to apply global gradient updates.
+    consolidation_device = '/gpu:0' if variable_strategy == 'GPU' else '/cpu:0'
+    with tf.device(consolidation_device):
+      predictions = {
+          'classes':
+              tf.concat([p['classes'] for p in tower_preds], axis=0),
+          'probabilities':
+              tf.concat([p['probabilities'] for p in tower_preds], axis=0)
+      }
+
+    if mode == tf.estimator.ModeKeys.PREDICT:
+      return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
+
     # Now compute global loss and gradients.
     gradvars = []
     with tf.name_scope('gradient_averaging'):
@@ -131,13 +160,11 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
             avg_grad = tf.multiply(tf.add_n(grads), 1. / len(grads))
         gradvars.append((avg_grad, var))
 
-    # Device that runs the ops to apply global gradient updates.
-    consolidation_device = '/gpu:0' if variable_strategy == 'GPU' else '/cpu:0'
     with tf.device(consolidation_device):
       # Suggested learning rate scheduling from
       # https://github.com/ppwwyyxx/tensorpack/blob/master/examples/ResNet/cifar10-resnet.py#L155
-      num_batches_per_epoch = cifar10.Cifar10DataSet.num_examples_per_epoch(
-          'train') // (params.train_batch_size * num_workers)
+      num_batches_per_epoch = num_train_examples // (
+          params.train_batch_size * num_workers)
       boundaries = [
           num_batches_per_epoch * x
           for x in np.array([82, 123, 300], dtype=np.int64)
@@ -158,6 +185,10 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
           tensors=tensors_to_log, every_n_iter=100)
 
       train_hooks = [logging_hook, examples_sec_hook]
+      eval_hooks = []
+      if stage_ops:
+        train_hooks.append(cifar10_utils.StagingPrefillHook())
+        eval_hooks.append(cifar10_utils.StagingPrefillHook())
 
       optimizer = tf.train.MomentumOptimizer(
           learning_rate=learning_rate, momentum=momentum)
@@ -174,26 +205,15 @@ def get_model_fn(num_gpus, variable_strategy, num_workers):
               gradvars, global_step=tf.train.get_global_step())
       ]
       train_op.extend(update_ops)
+      train_op.extend(stage_ops)
       train_op = tf.group(*train_op)
 
-      predictions = {
-          'classes':
-              tf.concat([p['classes'] for p in tower_preds], axis=0),
-          'probabilities':
-              tf.concat([p['probabilities'] for p in tower_preds], axis=0)
-      }
-      stacked_labels = tf.concat(labels, axis=0)
-      metrics = {
-          'accuracy':
-              tf.metrics.accuracy(stacked_labels, predictions['classes'])
-      }
-
-      eval_hook = tf.train.LoggingTensorHook(
-          tensors={
-            # 'classes': predictions['classes'],
-            'probability': predictions['probabilities'][0][3]
-          }, every_n_iter=1)
-      eval_hooks = [eval_hook]
+      stacked_labels = tf.concat(tower_labels, axis=0)
+      accuracy = tf.metrics.accuracy(stacked_labels, predictions['classes'])
+      if stage_ops:
+        # Stage the next eval shards with every metric update.
+        accuracy = (accuracy[0], tf.group(accuracy[1], *stage_ops))
+      metrics = {'accuracy': accuracy}
 
     return tf.estimator.EstimatorSpec(
         mode=mode,
@@ -214,14 +234,14 @@ def _tower_fn(is_training, weight_decay, feature, label, data_format,
     is_training: true if is training graph.
     weight_decay: weight regularization strength, a float.
     feature: a Tensor.
-    label: a Tensor.
+    label: a Tensor, or None to only build the predictions.
     data_format: channels_last (NHWC) or channels_first (NCHW).
     num_layers: number of layers, an int.
     batch_norm_decay: decay for batch normalization, a float.
     batch_norm_epsilon: epsilon for batch normalization, a float.
   Returns:
     A tuple with the loss for the tower, the gradients and parameters, and
-    predictions.
+    predictions. The loss and gradients are None if label is None.
   """
   model = cifar10_model.ResNetCifar10(
       num_layers,
@@ -234,6 +254,8 @@ def _tower_fn(is_training, weight_decay, feature, label, data_format,
       'classes': tf.argmax(input=logits, axis=1),
       'probabilities': tf.nn.softmax(logits)
   }
+  if label is None:
+    return None, None, tower_pred
 
   tower_loss = tf.losses.sparse_softmax_cross_entropy(
       logits=logits, labels=label)
@@ -252,7 +274,8 @@ def input_fn(data_dir,
              subset,
              num_shards,
              batch_size,
-             use_distortion_for_training=True):
+             use_distortion_for_training=True,
+             **dataset_kwargs):
   """Create input graph for model.
   Args:
     data_dir: Directory where TFRecords representing the dataset are located.
@@ -261,34 +284,42 @@ def input_fn(data_dir,
     batch_size: total batch size for training to be divided by the number of
     shards.
     use_distortion_for_training: True to use distortions.
+    **dataset_kwargs: options forwarded to cifar10.Cifar10DataSet, e.g. the
+    censor and reader settings.
   Returns:
     two lists of tensors for features and labels, each of num_shards length.
   """
   with tf.device('/cpu:0'):
     use_distortion = subset == 'train' and use_distortion_for_training
-    dataset = cifar10.Cifar10DataSet(data_dir, subset, use_distortion)
+    dataset = cifar10.Cifar10DataSet(data_dir, subset, use_distortion,
+                                     **dataset_kwargs)
     image_batch, label_batch = dataset.make_batch(batch_size)
     if num_shards <= 1:
       # No GPU available or only 1 GPU.
       return [image_batch], [label_batch]
 
-    # Note that passing num=batch_size is safe here, even though
-    # dataset.batch(batch_size) can, in some cases, return fewer than batch_size
-    # examples. This is because it does so only when repeating for a limited
-    # number of epochs, but our dataset repeats forever.
-    image_batch = tf.unstack(image_batch, num=batch_size, axis=0)
-    label_batch = tf.unstack(label_batch, num=batch_size, axis=0)
-    feature_shards = [[] for i in range(num_shards)]
-    label_shards = [[] for i in range(num_shards)]
-    for i in xrange(batch_size):
-      idx = i % num_shards
-      feature_shards[idx].append(image_batch[i])
-      label_shards[idx].append(label_batch[i])
-    feature_shards = [tf.parallel_stack(x) for x in feature_shards]
-    label_shards = [tf.parallel_stack(x) for x in label_shards]
+    # Hand every tower a contiguous slice of the batch with a single split.
+    # Splitting evenly is safe here, even though dataset.batch(batch_size) can,
+    # in some cases, return fewer than batch_size examples. This is because it
+    # does so only when repeating for a limited number of epochs, but our
+    # dataset repeats forever, and batch_size is a multiple of num_shards.
+    feature_shards = tf.split(image_batch, num_shards, axis=0)
+    label_shards = tf.split(label_batch, num_shards, axis=0)
     return feature_shards, label_shards
 
 
+def _dataset_kwargs(hparams):
+  """Returns the cifar10.Cifar10DataSet options set by the hparams."""
+  return {
+      'cycle_length': hparams.reader_cycle_length,
+      'block_length': hparams.reader_block_length,
+      'record_format': hparams.record_format,
+      'batch_parse': hparams.batch_parse,
+      'cache': hparams.cache,
+      'prefetch_batches': hparams.prefetch_batches,
+  }
+
+
 def get_experiment_fn(data_dir,
                       num_gpus,
                       variable_strategy,
@@ -316,22 +347,29 @@ def get_experiment_fn(data_dir,
   def _experiment_fn(run_config, hparams):
     """Returns an Experiment."""
     # Create estimator.
+    # Every worker replica trains on its own slice of the training set.
+    num_workers, worker_index = cifar10_utils.worker_shard(run_config)
     train_input_fn = functools.partial(
         input_fn,
         data_dir,
         subset='train',
         num_shards=num_gpus,
         batch_size=hparams.train_batch_size,
-        use_distortion_for_training=use_distortion_for_training)
+        use_distortion_for_training=use_distortion_for_training,
+        num_workers=num_workers,
+        worker_index=worker_index,
+        **_dataset_kwargs(hparams))
 
     eval_input_fn = functools.partial(
         input_fn,
         data_dir,
         subset='eval',
         batch_size=hparams.eval_batch_size,
-        num_shards=num_gpus)
+        num_shards=num_gpus,
+        **_dataset_kwargs(hparams))
 
-    num_eval_examples = cifar10.Cifar10DataSet.num_examples_per_epoch('eval')
+    num_eval_examples = cifar10.Cifar10DataSet.num_examples_per_epoch(
+        'eval', data_dir)
     if num_eval_examples % hparams.eval_batch_size != 0:
       raise ValueError(
           'validation set size must be multiple of eval_batch_size')
@@ -340,8 +378,9 @@ def get_experiment_fn(data_dir,
     eval_steps = num_eval_examples // hparams.eval_batch_size
 
     classifier = tf.estimator.Estimator(
-        model_fn=get_model_fn(num_gpus, variable_strategy,
-                              run_config.num_worker_replicas or 1),
+        model_fn=get_model_fn(
+            num_gpus, variable_strategy, run_config.num_worker_replicas or 1,
+            cifar10.Cifar10DataSet.num_examples_per_epoch('train', data_dir)),
         config=run_config,
         params=hparams)
 
@@ -358,7 +397,7 @@ def get_experiment_fn(data_dir,
 
 def main(job_dir, data_dir, num_gpus, variable_strategy,
          use_distortion_for_training, log_device_placement, num_intra_threads,
-         **hparams):
+         censor_output, **hparams):
   # The env variable is on deprecation path, default is set to off.
   os.environ['TF_SYNC_ON_FINISH'] = '0'
   os.environ['TF_ENABLE_WINOGRAD_NONFUSED'] = '1'
@@ -389,9 +428,13 @@ def main(job_dir, data_dir, num_gpus, variable_strategy,
   def evaluate_with_censor():
     """Evaluate model with censored image
 
-    Goal: Examine one image only and evaluate it with different
-    sections censored (i.e., blacked out). Create a heat-map of
-    most important/distinguishing pixels for analysis.
+    Goal: Examine every eval image with different sections censored
+    (i.e., blacked out). Create a heat-map of most important/distinguishing
+    pixels for analysis.
+
+    The censored variants are built inside the input pipeline from the
+    plain eval records unless --censor-patch-size is 0, in which case
+    eval.tfrecords is expected to hold pre-generated variants.
     """
 
     # Create estimator.
@@ -400,7 +443,10 @@ def main(job_dir, data_dir, num_gpus, variable_strategy,
         data_dir,
         subset='eval',
         batch_size=hparams.eval_batch_size,
-        num_shards=num_gpus)
+        num_shards=num_gpus,
+        censor_patch_size=hparams.censor_patch_size,
+        censor_stride=hparams.censor_stride,
+        **_dataset_kwargs(hparams))
 
     classifier = tf.estimator.Estimator(
         model_fn=get_model_fn(num_gpus, variable_strategy,
@@ -408,7 +454,9 @@ def main(job_dir, data_dir, num_gpus, variable_strategy,
         config=config,
         params=hparams)
 
-    num_eval_examples = cifar10.Cifar10DataSet.num_examples_per_epoch('eval')
+    num_eval_examples = cifar10.Cifar10DataSet(
+        data_dir, 'eval', False, hparams.censor_patch_size,
+        hparams.censor_stride).num_examples()
     if num_eval_examples % hparams.eval_batch_size != 0:
       raise ValueError(
           'validation set size must be multiple of eval_batch_size')
@@ -427,7 +475,95 @@ def main(job_dir, data_dir, num_gpus, variable_strategy,
         run_config=config,
         hparams=hparams)
 
-  evaluate_with_censor()
+  def predict_with_censor():
+    """Predict censored class probabilities for every eval image.
+
+    Streams the softmax output of every censored variant into a float32
+    .npy file of shape [image, window, class], window 0 being the
+    uncensored image, see cifar10_utils.PredictionSink. Analysts can slice
+    it without rerunning the model:
+      np.load(censor_output, mmap_mode='r')[image]
+
+    The variants of consecutive images share eval batches, so every
+    predict step runs on a full batch.
+
+    With --censor-adaptive, a coarse grid of windows is evaluated first and
+    only the windows of the coarse cells that lower the probability of the
+    predicted class by more than --censor-threshold are evaluated on the
+    full grid. The other windows take the probabilities of their coarse
+    cell, so the output keeps the same shape.
+    """
+    num_images = cifar10.Cifar10DataSet.num_examples_per_epoch(
+        'eval', data_dir)
+
+    classifier = tf.estimator.Estimator(
+        model_fn=get_model_fn(num_gpus, variable_strategy,
+                              config.num_worker_replicas or 1),
+        config=config,
+        params=hparams)
+
+    def censored_probabilities(stride, selection=None):
+      """Yields the probabilities of the selected censored variants."""
+      dataset = cifar10.Cifar10DataSet(data_dir, 'eval', False,
+                                       hparams.censor_patch_size, stride,
+                                       selection)
+      predict_input_fn = functools.partial(
+          input_fn,
+          data_dir,
+          subset='eval',
+          batch_size=hparams.eval_batch_size,
+          num_shards=num_gpus,
+          censor_patch_size=hparams.censor_patch_size,
+          censor_stride=stride,
+          censor_selection=selection,
+          **_dataset_kwargs(hparams))
+      # The input pipeline repeats forever, stop after one pass.
+      predictions = itertools.islice(
+          classifier.predict(predict_input_fn, predict_keys=['probabilities']),
+          dataset.num_examples())
+      for prediction in predictions:
+        yield prediction['probabilities']
+
+    num_variants = cifar10.Cifar10DataSet(
+        data_dir, 'eval', False, hparams.censor_patch_size,
+        hparams.censor_stride).num_variants()
+    sink = cifar10_utils.PredictionSink(
+        censor_output, (num_images, num_variants),
+        axes=('image', 'window', 'class'))
+
+    if not hparams.censor_adaptive:
+      sink.extend(censored_probabilities(hparams.censor_stride))
+      sink.close()
+      return
+
+    coarse = np.array(list(censored_probabilities(hparams.censor_coarse_stride)))
+    coarse = coarse.reshape(num_images, -1, coarse.shape[-1])
+    classes = np.argmax(coarse[:, 0], axis=1)
+    owner = occlusion.coarse_windows(hparams.censor_patch_size,
+                                     hparams.censor_stride,
+                                     hparams.censor_coarse_stride)
+    selection = occlusion.refine_windows(
+        coarse[np.arange(num_images), :, classes], hparams.censor_threshold,
+        owner)
+
+    probabilities = np.empty((num_images, num_variants, coarse.shape[-1]),
+                             dtype=np.float32)
+    probabilities[:, 0] = coarse[:, 0]
+    probabilities[:, 1:] = coarse[:, 1 + owner]
+    refined = list(censored_probabilities(hparams.censor_stride, selection))
+    if refined:
+      probabilities[selection] = refined
+    tf.logging.info('Adaptive censoring ran %d forward passes instead of %d',
+                    coarse.shape[0] * coarse.shape[1] + len(refined),
+                    num_images * num_variants)
+
+    sink.extend(probabilities.reshape(-1, probabilities.shape[-1]))
+    sink.close()
+
+  if censor_output:
+    predict_with_censor()
+  else:
+    evaluate_with_censor()
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -503,6 +639,14 @@ if __name__ == '__main__':
       help="""\
       If present when running in a distributed environment will run on sync mode.\
       """)
+  parser.add_argument(
+      '--stage-inputs',
+      action='store_true',
+      default=False,
+      help="""\
+      If present, stage the input shard of every tower on its device, so that
+      the next shard is copied while the current step runs.\
+      """)
   parser.add_argument(
       '--num-intra-threads',
       type=int,
@@ -543,6 +687,96 @@ if __name__ == '__main__':
       type=float,
       default=1e-5,
       help='Epsilon for batch norm.')
+  parser.add_argument(
+      '--record-format',
+      choices=['tfrecord', 'array'],
+      type=str,
+      default='tfrecord',
+      help="""\
+      Read the TFRecord files, or slice batches out of the memory-mapped
+      .npy arrays written by generate_cifar10_tfrecords.py.\
+      """)
+  parser.add_argument(
+      '--batch-parse',
+      action='store_true',
+      default=False,
+      help="""\
+      If present, batch the serialized TFRecords first and parse, decode and
+      convert whole batches at once.\
+      """)
+  parser.add_argument(
+      '--cache',
+      type=str,
+      default=None,
+      help="""\
+      If set, keep the decoded uint8 images. 'memory' reads the subset into
+      memory once and shuffles indices over it, anything else is a directory
+      where the images decoded during the first epoch are cached.\
+      """)
+  parser.add_argument(
+      '--prefetch-batches',
+      type=int,
+      default=1,
+      help="""\
+      Number of batches prepared ahead of the model. If set to 0, no
+      prefetching is done.\
+      """)
+  parser.add_argument(
+      '--reader-cycle-length',
+      type=int,
+      default=4,
+      help='Number of training TFRecord shards read in parallel.')
+  parser.add_argument(
+      '--reader-block-length',
+      type=int,
+      default=1,
+      help="""\
+      Number of consecutive records read from one training shard before
+      moving to the next one.\
+      """)
+  parser.add_argument(
+      '--censor-patch-size',
+      type=int,
+      default=8,
+      help="""\
+      Side of the square window blacked out when evaluating with censored
+      images. If 0, eval.tfrecords is expected to already hold the censored
+      variants written by generate_cifar10_tfrecords.py.\
+      """)
+  parser.add_argument(
+      '--censor-stride',
+      type=int,
+      default=2,
+      help='Distance between two neighbouring censored windows.')
+  parser.add_argument(
+      '--censor-output',
+      type=str,
+      default=None,
+      help="""\
+      If set, predict the censored class probabilities of every eval image
+      and write them to this .npy file instead of evaluating.\
+      """)
+  parser.add_argument(
+      '--censor-adaptive',
+      action='store_true',
+      default=False,
+      help="""\
+      If present with --censor-output, evaluate a coarse grid of censored
+      windows first and refine only the windows that matter.\
+      """)
+  parser.add_argument(
+      '--censor-coarse-stride',
+      type=int,
+      default=8,
+      help='Distance between two neighbouring windows of the coarse grid.')
+  parser.add_argument(
+      '--censor-threshold',
+      type=float,
+      default=0.05,
+      help="""\
+      Minimum drop in the probability of the predicted class for a coarse
+      window to be refined.\
+      """)
   args = parser.parse_args()
 
   if args.num_gpus > 0:
@@ -1,4 +1,6 @@
 import collections
+import json
+import numpy as np
 import six
 
 import tensorflow as tf
@@ -48,6 +50,21 @@ class RunConfig(tf.contrib.learn.RunConfig):
         '%s=%r' % (k, v) for (k, v) in six.iteritems(ordered_state))
 
 
+def worker_shard(config):
+  """Returns the (num_workers, worker_index) input shard of a replica.
+  The master or chief, if any, is worker 0 and the workers follow it. Other
+  tasks, e.g. evaluators, and local runs read the whole dataset.
+  """
+  num_workers = config.num_worker_replicas or 1
+  if config.task_type in ('master', 'chief'):
+    return num_workers, 0
+  if config.task_type == 'worker':
+    cluster = config.cluster_spec.as_dict() if config.cluster_spec else {}
+    has_chief = 'master' in cluster or 'chief' in cluster
+    return num_workers, config.task_id + int(has_chief)
+  return 1, 0
+
+
 class ExamplesPerSecondHook(session_run_hook.SessionRunHook):
   """Hook to print out examples per second.
     Total time is tracked and then divided by the total number of steps
@@ -107,6 +124,120 @@ class ExamplesPerSecondHook(session_run_hook.SessionRunHook):
                      average_examples_per_sec, current_examples_per_sec,
                      self._total_steps)
 
+
+STAGING_PUT_OPS = 'staging_put_ops'
+
+
+def stage(tensors):
+  """Stages `tensors` in a StagingArea on the current device.
+  Returns the tensors read from the area and the op putting `tensors` in it.
+  Running the put op with the step that reads the area copies the next
+  tensors to the device while the step computes. The area must hold one
+  element before the first read, see StagingPrefillHook.
+  """
+  area = tf.contrib.staging.StagingArea(dtypes=[t.dtype for t in tensors])
+  put_op = area.put(tensors)
+  tf.add_to_collection(STAGING_PUT_OPS, put_op)
+  staged = area.get()
+  if not isinstance(staged, (list, tuple)):
+    staged = [staged]
+  for staged_tensor, tensor in zip(staged, tensors):
+    staged_tensor.set_shape(tensor.shape)
+  return list(staged), put_op
+
+
+class StagingPrefillHook(session_run_hook.SessionRunHook):
+  """Hook filling every staging area of the graph once.
+  Runs the put ops created by `stage` when the session is created, so that
+  the first step finds its inputs staged.
+  """
+
+  def begin(self):
+    self._put_ops = tf.get_collection(STAGING_PUT_OPS)
+
+  def after_create_session(self, session, coord):  # pylint: disable=unused-argument
+    if self._put_ops:
+      session.run(self._put_ops)
+
+
+class PredictionSink(object):
+  """Streams prediction rows into a memory-mapped .npy file.
+    Rows are buffered and written in blocks, in C order of `shape`. The array
+    is allocated on the first row, once the row length is known. Closing the
+    sink writes a JSON index next to the array, `<filename>.index.json`, that
+    names the axes and records how many rows were written.
+  """
+
+  def __init__(self, filename, shape, axes=None, dtype=np.float32,
+               buffer_rows=4096):
+    """Initializer for PredictionSink.
+      Args:
+      filename: path of the .npy file to write.
+      shape: leading dimensions of the array, the row length is appended.
+      axes: optional names of all dimensions, including the row.
+      dtype: dtype of the array.
+      buffer_rows: number of rows buffered before a block is written.
+    """
+    self._filename = filename
+    self._shape = tuple(shape)
+    self._axes = axes
+    self._dtype = np.dtype(dtype)
+    self._buffer_rows = buffer_rows
+    self._buffer = []
+    self._array = None
+    self._rows = None
+    self._num_rows = 0
+
+  @property
+  def capacity(self):
+    """Number of rows the array holds."""
+    return int(np.prod(self._shape))
+
+  def append(self, row):
+    """Appends one row, e.g. the probabilities of one prediction."""
+    if self._num_rows + len(self._buffer) >= self.capacity:
+      raise ValueError('PredictionSink is full.')
+    self._buffer.append(row)
+    if len(self._buffer) >= self._buffer_rows:
+      self._flush_buffer()
+
+  def extend(self, rows):
+    """Appends a block of rows."""
+    for row in rows:
+      self.append(row)
+
+  def _flush_buffer(self):
+    if not self._buffer:
+      return
+    if self._array is None:
+      self._array = np.lib.format.open_memmap(
+          self._filename, mode='w+', dtype=self._dtype,
+          shape=self._shape + (len(self._buffer[0]),))
+      self._rows = self._array.reshape(self.capacity, -1)
+    end = self._num_rows + len(self._buffer)
+    self._rows[self._num_rows:end] = self._buffer
+    self._num_rows = end
+    self._buffer = []
+
+  def close(self):
+    """Flushes the array to disk and writes its index."""
+    self._flush_buffer()
+    if self._array is None:
+      return
+    self._array.flush()
+    index = {
+        'filename': self._filename,
+        'shape': list(self._array.shape),
+        'dtype': self._dtype.name,
+        'axes': list(self._axes) if self._axes else None,
+        'rows_written': self._num_rows,
+    }
+    with open(self._filename + '.index.json', 'w') as f:
+      json.dump(index, f, indent=2)
+    logging.info('Wrote %d prediction rows to %s', self._num_rows,
+                 self._filename)
+
+
 def local_device_setter(num_devices=1,
                         ps_device_type='cpu',
                         worker_device='/cpu:0',
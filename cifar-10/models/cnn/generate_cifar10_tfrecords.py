@@ -16,6 +16,9 @@
 Generates tf.train.Example protos and writes them to TFRecord files from the
 python version of the CIFAR-10 dataset downloaded from
 https://www.cs.toronto.edu/~kriz/cifar.html.
+Every TFRecord file gets a <file>.index sidecar with the byte offset of each
+record, see tfrecord_index.py. Also writes every subset as packed uint8 .npy
+arrays of images and labels.
 """
 
 from __future__ import absolute_import
@@ -24,6 +27,9 @@ from __future__ import print_function
 
 import numpy as np
 import argparse
+import glob
+import json
+import multiprocessing
 import os
 import cv2
 
@@ -32,9 +38,17 @@ from six.moves import cPickle as pickle
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
+import occlusion
+import tfrecord_index
+
 CIFAR_FILENAME = 'cifar-10-python.tar.gz'
 CIFAR_DOWNLOAD_URL = 'https://www.cs.toronto.edu/~kriz/' + CIFAR_FILENAME
 CIFAR_LOCAL_FOLDER = 'cifar-10-batches-py'
+MANIFEST_FILENAME = 'manifest.json'
+RECORDS_PER_BATCH = 10000
+# Number of images occluded at once, about 50 MB of variants with the default
+# 8x8 windows and stride 2.
+CENSOR_CHUNK = 32
 
 
 def download_and_extract(data_dir):
@@ -68,100 +82,227 @@ def read_pickle_from_file(filename):
   return data_dict
 
 
-def convert_to_tfrecord(input_files, output_file):
-  """Converts a file to TFRecords."""
-  def to_image(array):
-    channels = np.split(array, 3)
-    proc = []
-    for i in xrange(len(channels[0])):
-      for j in [0,1,2]:
-        proc.append(channels[j][i])
-    proc = np.array(proc)
-    image = np.reshape(proc, (32, 32, 3))
-    return image
-
-  def to_array(image):
-    proc = []
-    for c in [0,1,2]:
-      for x in xrange(len(image[0])):
-        for y in xrange(len(image[0])):
-          proc.append(image[x][y][c])
-    array = np.array(proc)
-    return array
-
+def shard_filename(subset, shard, num_shards):
+  """Returns the name of one TFRecord shard of a subset."""
+  if num_shards == 1:
+    return subset + '.tfrecords'
+  return '%s-%05d-of-%05d.tfrecords' % (subset, shard, num_shards)
+
+
+def convert_to_tfrecord(input_files, output_file, censor_indices=None,
+                        censor_patch_size=8, censor_stride=2, shard=0,
+                        num_shards=1, images_file=None, labels_file=None):
+  """Converts a file to TFRecords.
+  If `censor_indices` is given, the test batch is replaced by the occluded
+  variants of those images, each original image followed by its windows.
+  Only the `shard`-th of `num_shards` contiguous slices of the records is
+  read and written, followed by its index sidecar. If `images_file` and
+  `labels_file` are given, the slice is also written at its place in these
+  .npy arrays, see _allocate_arrays. Returns the number of records written.
+  """
   print('Generating %s' % output_file)
+  counts = _count_records(input_files, censor_indices, censor_patch_size,
+                          censor_stride)
+  start = shard * sum(counts) // num_shards
+  end = (shard + 1) * sum(counts) // num_shards
+
+  if images_file is not None:
+    images = np.load(images_file, mmap_mode='r+')
+    labels = np.load(labels_file, mmap_mode='r+')
+  offset = start
+  lengths = []
   with tf.python_io.TFRecordWriter(output_file) as record_writer:
-    for input_file in input_files:
-      data_dict = read_pickle_from_file(input_file)
-      data = [data_dict['data'][8]]
-      labels = [data_dict['labels'][8]]
-
-      if 'test_batch' in input_file:
-        print(labels)
-
-        ctr = 0
-        for image in data:
-          images = []
-
-          image = to_image(np.array(image))
-
-          cv2.imwrite(os.path.join('censor_data', 'img_{}.png'.format(ctr)), image)
-          images.append(to_array(image))  # start with original image
-
-          # black out rectangles of the image to make sub imgs
-          delta = [2, 2]  # [x, y] delta
-          part_size = [32 // 4, 32 // 4]
-          divisions = [(32 - part_size[0]) // delta[0], (32 - part_size[1]) // delta[1]]
-          for i in xrange(divisions[0] + 1):
-            for j in xrange(divisions[1] + 1):
-              x = i * delta[0]
-              y = j * delta[1]
-              # (x, y) is the top left corner of the rectangle
-
-              img = image.copy()
-
-              for x_offset in xrange(part_size[0]):
-                for y_offset in xrange(part_size[1]):
-                  img[x + x_offset][y + y_offset] = [0, 0, 0]
-
-              img = to_image(to_array(img))
-
-              # cv2.imwrite(os.path.join('censor_data', 'img_{%02d}_{%02d}.png'.format(i,j)), img)
-              images.append(to_array(img))
-
-          for im in images:
-            example = tf.train.Example(features=tf.train.Features(
-                feature={
-                    'image': _bytes_feature(im.tobytes()),
-                    'label': _int64_feature(labels[ctr])
-                }))
-            record_writer.write(example.SerializeToString())
-
-          ctr += 1
-
-      # num_entries_in_batch = len(labels)
-      # for i in range(num_entries_in_batch):
-      #   example = tf.train.Example(features=tf.train.Features(
-      #       feature={
-      #           'image': _bytes_feature(data[i].tobytes()),
-      #           'label': _int64_feature(labels[i])
-      #       }))
-      #   record_writer.write(example.SerializeToString())
-
-def main(data_dir):
+    for data, data_labels in _iter_records(
+        input_files, censor_indices, censor_patch_size, censor_stride,
+        start, end):
+      for image, label in zip(data, data_labels):
+        example = tf.train.Example(features=tf.train.Features(
+            feature={
+                'image': _bytes_feature(image.tobytes()),
+                'label': _int64_feature(int(label))
+            }))
+        serialized = example.SerializeToString()
+        record_writer.write(serialized)
+        lengths.append(len(serialized))
+      if images_file is not None:
+        images[offset:offset + len(data)] = _to_images(data)
+        labels[offset:offset + len(data)] = data_labels
+      offset += len(data)
+  if images_file is not None:
+    images.flush()
+    labels.flush()
+  tfrecord_index.write_index(output_file,
+                             tfrecord_index.record_offsets(lengths))
+  return end - start
+
+
+def _allocate_arrays(images_file, labels_file, num_records):
+  """Creates the images and labels .npy arrays and returns them mapped."""
+  images = np.lib.format.open_memmap(images_file, mode='w+', dtype=np.uint8,
+                                     shape=(num_records, 32, 32, 3))
+  labels = np.lib.format.open_memmap(labels_file, mode='w+', dtype=np.int32,
+                                     shape=(num_records,))
+  return images, labels
+
+
+def _to_images(data):
+  """Converts rows of channel major records to [N, height, width, depth]."""
+  return data.reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+
+
+def _is_censored(input_file, censor_indices):
+  return bool(censor_indices) and 'test_batch' in input_file
+
+
+def _count_records(input_files, censor_indices, censor_patch_size,
+                   censor_stride):
+  """Returns the number of records of every input file, without reading it."""
+  num_variants = occlusion.num_windows(censor_patch_size, censor_stride) + 1
+  counts = []
+  for input_file in input_files:
+    if not _is_censored(input_file, censor_indices):
+      counts.append(RECORDS_PER_BATCH)
+    elif censor_indices == 'all':
+      counts.append(RECORDS_PER_BATCH * num_variants)
+    else:
+      counts.append(len(censor_indices) * num_variants)
+  return counts
+
+
+def _iter_records(input_files, censor_indices, censor_patch_size,
+                  censor_stride, start, end):
+  """Yields the uint8 images and labels of records [start, end) in chunks.
+  Only the input files overlapping the range are read, and only the images
+  whose variants fall in it are censored, CENSOR_CHUNK images at a time.
+  """
+  counts = _count_records(input_files, censor_indices, censor_patch_size,
+                          censor_stride)
+  first = 0
+  for input_file, count in zip(input_files, counts):
+    low = max(start - first, 0)
+    high = min(end - first, count)
+    first += count
+    if low >= high:
+      continue
+
+    data_dict = read_pickle_from_file(input_file)
+    data = np.asarray(data_dict['data'], dtype=np.uint8)
+    labels = np.asarray(data_dict['labels'])
+    if not _is_censored(input_file, censor_indices):
+      yield data[low:high], labels[low:high]
+      continue
+
+    indices = censor_indices
+    if indices == 'all':
+      indices = np.arange(len(data))
+    num_variants = count // len(indices)
+    first_image = low // num_variants
+    end_image = (high - 1) // num_variants + 1
+    for chunk_start in xrange(first_image, end_image, CENSOR_CHUNK):
+      chunk = np.asarray(
+          indices[chunk_start:min(chunk_start + CENSOR_CHUNK, end_image)])
+      # Every image is written by the task holding its original variant.
+      for i, index in enumerate(chunk, chunk_start):
+        if low <= i * num_variants < high:
+          _write_censor_image(index, data[index])
+      variants, variant_labels = _censor_images(
+          data, labels, chunk, censor_patch_size, censor_stride)
+      offset = chunk_start * num_variants
+      yield (variants[max(low - offset, 0):high - offset],
+             variant_labels[max(low - offset, 0):high - offset])
+
+
+def _convert_shard(task):
+  """Pool entry point, converts one TFRecord shard.
+  Returns its mode and its manifest entry.
+  """
+  mode, kwargs = task
+  num_records = convert_to_tfrecord(**kwargs)
+  output_file = kwargs['output_file']
+  return mode, {
+      'filename': os.path.basename(output_file),
+      'index': os.path.basename(tfrecord_index.index_filename(output_file)),
+      'num_records': num_records
+  }
+
+
+def _write_censor_image(index, image):
+  """Writes the original of a censored image to censor_data/."""
+  image = image.reshape(3, 32, 32).transpose(1, 2, 0)
+  cv2.imwrite(os.path.join('censor_data', 'img_{}.png'.format(index)), image)
+
+
+def _censor_images(data, labels, indices, patch_size, stride):
+  """Returns the occluded variants and labels of the selected images."""
+  data = np.asarray(data)[indices]
+  labels = np.asarray(labels)[indices]
+
+  variants = occlusion.occlude(data, patch_size, stride)
+  num_variants = variants.shape[1]
+  return (variants.reshape(-1, variants.shape[-1]),
+          np.repeat(labels, num_variants))
+
+
+def _parse_indices(value):
+  """Parses the --censor-indices flag."""
+  if value == 'all':
+    return value
+  return [int(i) for i in value.split(',') if i.strip()]
+
+
+def main(data_dir, censor_indices, censor_patch_size, censor_stride,
+         num_shards, num_workers):
   print('Download from {} and extract.'.format(CIFAR_DOWNLOAD_URL))
   download_and_extract(data_dir)
   file_names = _get_file_names()
   input_dir = os.path.join(data_dir, CIFAR_LOCAL_FOLDER)
+  tasks = []
+  arrays = {}
   for mode, files in file_names.items():
     input_files = [os.path.join(input_dir, f) for f in files]
-    output_file = os.path.join(data_dir, mode + '.tfrecords')
-    try:
-      os.remove(output_file)
-    except OSError:
-      pass
-    # Convert to tf.train.Example and write the to TFRecords.
-    convert_to_tfrecord(input_files, output_file)
+    for stale_file in (
+        glob.glob(os.path.join(data_dir, mode + '.tfrecords*')) +
+        glob.glob(os.path.join(data_dir, mode + '-*-of-*.tfrecords*'))):
+      os.remove(stale_file)
+    censor_kwargs = {
+        'input_files': input_files,
+        'censor_indices': _parse_indices(censor_indices),
+        'censor_patch_size': censor_patch_size,
+        'censor_stride': censor_stride,
+    }
+    # Every shard task reads and writes its own slice of the records, into
+    # its TFRecord file and into the packed arrays allocated here.
+    images_file = os.path.join(data_dir, mode + '_images.npy')
+    labels_file = os.path.join(data_dir, mode + '_labels.npy')
+    num_records = sum(_count_records(**censor_kwargs))
+    _allocate_arrays(images_file, labels_file, num_records)
+    arrays[mode] = {'images': os.path.basename(images_file),
+                    'labels': os.path.basename(labels_file),
+                    'num_records': num_records}
+    for shard in xrange(num_shards):
+      output_file = os.path.join(data_dir,
+                                 shard_filename(mode, shard, num_shards))
+      tasks.append((mode, dict(
+          censor_kwargs, output_file=output_file, shard=shard,
+          num_shards=num_shards, images_file=images_file,
+          labels_file=labels_file)))
+
+  # Convert to tf.train.Example and write the to TFRecords.
+  pool = multiprocessing.Pool(num_workers or None)
+  try:
+    results = pool.map(_convert_shard, tasks)
+  finally:
+    pool.close()
+    pool.join()
+
+  manifest = {}
+  for mode, entry in results:
+    subset = manifest.setdefault(
+        mode, {'files': [], 'num_records': 0, 'arrays': arrays[mode]})
+    subset['files'].append(entry)
+    subset['num_records'] += entry['num_records']
+  with open(os.path.join(data_dir, MANIFEST_FILENAME), 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
   print('Done!')
 
 
@@ -172,6 +313,43 @@ if __name__ == '__main__':
       type=str,
       default='',
       help='Directory to download and extract CIFAR-10 to.')
+  parser.add_argument(
+      '--censor-indices',
+      type=str,
+      default='',
+      help="""\
+      Comma separated indices of the test images to write as occluded
+      variants instead of the plain test set, or "all". Leave empty to write
+      the plain test set, which cifar10_main.py censors on the fly.\
+      """)
+  parser.add_argument(
+      '--censor-patch-size',
+      type=int,
+      default=8,
+      help='Side of the square window blacked out in each variant.')
+  parser.add_argument(
+      '--censor-stride',
+      type=int,
+      default=2,
+      help='Distance between two neighbouring occlusion windows.')
+  parser.add_argument(
+      '--num-shards',
+      type=int,
+      default=1,
+      help="""\
+      Number of TFRecord shards written per subset, named like
+      train-00000-of-00008.tfrecords. A single shard is written to
+      <subset>.tfrecords. With at least as many shards as training workers,
+      the workers split whole files among them.\
+      """)
+  parser.add_argument(
+      '--num-workers',
+      type=int,
+      default=0,
+      help="""\
+      Number of conversion processes. If set to 0, one process per CPU core
+      is used.\
+      """)
 
   args = parser.parse_args()
-  main(args.data_dir)
+  main(**vars(args))
@@ -1,72 +1,88 @@
-from math import sqrt
+import argparse
+import os
 import numpy as np
 import cv2
 
-def parse_probabilities(filename):
-    lines = []
-    with open(filename, 'r') as fp:
-        for line in fp:
-            if line:
-                lines.append(line.strip())
+import occlusion
 
-    return lines
+def parse_probabilities(filename, class_index=None):
+    """Loads censored probabilities as an [image, window + 1] array.
 
-if __name__ == '__main__':
-    probs = parse_probabilities('probabilities')
-    num_regions = len(probs) - 1  # not including original image
-    num_parts = int(sqrt(num_regions))
+    Reads the [image, window + 1, class] .npy array written by
+    `cifar10_main.py --censor-output` without loading it in memory, and
+    picks `class_index`, or else the class predicted on the uncensored
+    image. Window 0 is the uncensored image.
+    """
+    probs = np.load(filename, mmap_mode='r')
+    if probs.ndim == 2:
+        probs = probs[None]
+    if class_index is None:
+        classes = np.argmax(probs[:, 0], axis=1)
+    else:
+        classes = np.full(len(probs), class_index)
+    return probs[np.arange(len(probs)), :, classes]
 
-    original_prob = float(probs[0])
-    max_prob = float(max(probs))
-    min_prob = float(min(probs))
+def box_sum(grid, size):
+    """Sums `grid` [..., height, width] over the size x size box ending at
+    every pixel, using a summed-area table."""
+    table = np.cumsum(np.cumsum(grid, axis=-2), axis=-1)
+    pad = [(0, 0)] * (table.ndim - 2) + [(size, 0), (size, 0)]
+    table = np.pad(table, pad, mode='constant')
+    return (table[..., size:, size:] - table[..., :-size, size:] -
+            table[..., size:, :-size] + table[..., :-size, :-size])
 
-    heatmap = np.zeros((32, 32, 2))
-    for i in range(32):
-        for j in range(32):
-            heatmap[i][j] = [0, 0]
+def heatmaps(scores, patch_size=8, stride=2, height=32, width=32):
+    """Turns per-window scores into heatmaps.
 
-    counter = 0
-    delta = [2, 2]
-    part_size = [32 // 4, 32 // 4]
-    divisions = [(32 - part_size[0]) // delta[0], (32 - part_size[1]) // delta[1]]
-    for i in range(divisions[0] + 1):
-      for j in range(divisions[1] + 1):
-        x = i * delta[0]
-        y = j * delta[1]
-        # (x, y) is the top left corner of the rectangle
+    Args:
+        scores: [image, window] array of the target class probability with
+            each window censored, windows ordered as in occlusion.window_grid.
+    Returns:
+        A [image, height, width] array in [0, 255], the hottest pixels being
+        those whose censoring lowers the probability the most.
+    """
+    rows, cols = occlusion.window_grid(patch_size, stride, height, width)
+    scores = np.asarray(scores, dtype=np.float64)
+    scores = scores.reshape(-1, len(rows), len(cols))
 
-        for x_offset in range(part_size[0]):
-          for y_offset in range(part_size[1]):
-            heatmap[x + x_offset][y + y_offset][0] += 1
-            heatmap[x + x_offset][y + y_offset][1] += float(probs[counter])
+    # Drop every window score on its top left corner, then sum the windows
+    # covering each pixel with one box filter.
+    corners = np.zeros((len(scores), height, width))
+    corners[:, rows[:, None], cols] = scores
+    counts = np.zeros((height, width))
+    counts[rows[:, None], cols] = 1
 
-        counter += 1
+    totals = box_sum(corners, patch_size)
+    counts = box_sum(counts, patch_size)
+    image = np.where(counts > 0, totals / np.maximum(counts, 1), 0)
 
-    image = np.zeros((32, 32))
     # normalize
-    for i in range(32):
-        for j in range(32):
-            if heatmap[i][j][0] == 0:
-                image[i][j] = 0
-            else:
-                image[i][j] = heatmap[i][j][1] / heatmap[i][j][0]
-
-    max_ = -1
-    min_ = 10000000000
-    for row in image:
-        for elt in row:
-            if elt > max_:
-                max_ = elt
-            if elt < min_:
-                min_ = elt
+    min_ = image.min(axis=(1, 2), keepdims=True)
+    max_ = image.max(axis=(1, 2), keepdims=True)
+    span = max_ - min_
+    heat = np.where(span > 0, 1 - (image - min_) / np.where(span > 0, span, 1), 0)
+    return heat * 255.0
 
-    for i in range(32):
-        for j in range(32):
-            if max_ - min_ == 0:
-                heat = 0
-            else:
-                heat = 1 - ((image[i][j] - min_) / (max_ - min_))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--probabilities', default='probabilities.npy',
+                        help='.npy censor output of cifar10_main.py.')
+    parser.add_argument('--class-index', type=int, default=None,
+                        help='Class to explain, defaults to the prediction.')
+    parser.add_argument('--patch-size', type=int, default=8)
+    parser.add_argument('--stride', type=int, default=2)
+    parser.add_argument('--output', default='cat_heatmap.png',
+                        help='Image path, suffixed by the image index when '
+                             'several heatmaps are written.')
+    args = parser.parse_args()
 
-            image[i][j] = heat * 255.0
+    probs = parse_probabilities(args.probabilities, args.class_index)
+    # not including original image
+    images = heatmaps(probs[:, 1:], args.patch_size, args.stride)
 
-    cv2.imwrite('cat_heatmap.png', image)
+    if len(images) == 1:
+        cv2.imwrite(args.output, images[0])
+    else:
+        root, ext = os.path.splitext(args.output)
+        for i, image in enumerate(images):
+            cv2.imwrite('{}_{:05d}{}'.format(root, i, ext), image)
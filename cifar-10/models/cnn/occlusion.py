@@ -0,0 +1,111 @@
+"""Occlusion sensitivity helpers for CIFAR-10 images.
+Blacks out square windows of an image so that the change in the predicted
+class probability can be attributed to the covered region.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+HEIGHT = 32
+WIDTH = 32
+DEPTH = 3
+
+
+def window_grid(patch_size, stride, height=HEIGHT, width=WIDTH):
+  """Returns the top left rows and columns of the occlusion windows."""
+  if patch_size <= 0 or stride <= 0:
+    raise ValueError('patch_size and stride must be positive.')
+  rows = np.arange(0, height - patch_size + 1, stride)
+  cols = np.arange(0, width - patch_size + 1, stride)
+  return rows, cols
+
+
+def num_windows(patch_size, stride, height=HEIGHT, width=WIDTH):
+  """Returns the number of occlusion windows, not counting the original."""
+  rows, cols = window_grid(patch_size, stride, height, width)
+  return len(rows) * len(cols)
+
+
+def occlusion_masks(patch_size, stride, height=HEIGHT, width=WIDTH):
+  """Builds the keep-masks for every occlusion window.
+  Args:
+    patch_size: side of the square window that is blacked out, an int.
+    stride: distance between two neighbouring windows, an int.
+    height: image height.
+    width: image width.
+  Returns:
+    A uint8 array of shape [num_windows + 1, height, width]. Mask 0 keeps the
+    whole image, mask k > 0 zeroes the k-th window. Windows are ordered row
+    major, i.e. the column offset changes fastest.
+  """
+  rows, cols = window_grid(patch_size, stride, height, width)
+  ys = np.arange(height)
+  xs = np.arange(width)
+  in_rows = (ys >= rows[:, None]) & (ys < rows[:, None] + patch_size)
+  in_cols = (xs >= cols[:, None]) & (xs < cols[:, None] + patch_size)
+  covered = in_rows[:, None, :, None] & in_cols[None, :, None, :]
+
+  masks = np.ones((len(rows) * len(cols) + 1, height, width), dtype=np.uint8)
+  masks[1:] = ~covered.reshape(-1, height, width)
+  return masks
+
+
+def occlude(images, patch_size, stride):
+  """Returns the occluded variants of a batch of CIFAR-10 records.
+  Args:
+    images: uint8 array of shape [N, DEPTH * HEIGHT * WIDTH] in the channel
+      major layout of the python CIFAR-10 batches.
+    patch_size: side of the square window that is blacked out, an int.
+    stride: distance between two neighbouring windows, an int.
+  Returns:
+    A uint8 array of shape [N, num_windows + 1, DEPTH * HEIGHT * WIDTH].
+    Variant 0 of every image is the original image.
+  """
+  images = np.asarray(images, dtype=np.uint8)
+  images = images.reshape(-1, 1, DEPTH, HEIGHT, WIDTH)
+  masks = occlusion_masks(patch_size, stride)[None, :, None]
+  variants = images * masks
+  return variants.reshape(len(images), -1, DEPTH * HEIGHT * WIDTH)
+
+
+def coarse_windows(patch_size, stride, coarse_stride, height=HEIGHT,
+                   width=WIDTH):
+  """Maps every window to the coarse window holding its top left corner.
+  Args:
+    patch_size: side of the square window that is blacked out, an int.
+    stride: distance between two neighbouring windows of the fine grid.
+    coarse_stride: distance between two neighbouring windows of the coarse
+      grid.
+    height: image height.
+    width: image width.
+  Returns:
+    An int array of shape [num_windows(patch_size, stride)] with the index of
+    the owning window in the coarse grid. The coarse windows partition the
+    fine grid.
+  """
+  rows, cols = window_grid(patch_size, stride, height, width)
+  coarse_rows, coarse_cols = window_grid(patch_size, coarse_stride, height,
+                                         width)
+  row_owner = np.searchsorted(coarse_rows, rows, side='right') - 1
+  col_owner = np.searchsorted(coarse_cols, cols, side='right') - 1
+  return (row_owner[:, None] * len(coarse_cols) + col_owner).ravel()
+
+
+def refine_windows(coarse_scores, threshold, owner):
+  """Selects the fine windows worth evaluating.
+  Args:
+    coarse_scores: array of shape [N, num_coarse_windows + 1] with the target
+      class probability of every coarse variant, variant 0 being the original.
+    threshold: minimum probability drop for a coarse window to be refined.
+    owner: coarse window of every fine window, see coarse_windows.
+  Returns:
+    A bool array of shape [N, num_windows + 1] selecting the fine variants
+    whose coarse window lowers the probability by more than threshold. The
+    original image, variant 0, is never selected.
+  """
+  coarse_scores = np.asarray(coarse_scores)
+  drops = coarse_scores[:, :1] - coarse_scores[:, 1:]
+  selection = np.zeros((len(coarse_scores), len(owner) + 1), dtype=bool)
+  selection[:, 1:] = (drops > threshold)[:, owner]
+  return selection
@@ -0,0 +1,141 @@
+"""Record-offset index sidecars for TFRecord files.
+Next to every TFRecord file, generate_cifar10_tfrecords.py writes
+<file>.index holding the byte offset of every record as little-endian int64.
+The record count is the sidecar size divided by 8, so files can be counted,
+split among workers and read at random without being scanned. Only
+uncompressed TFRecord files are supported.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import struct
+
+import numpy as np
+import tensorflow as tf
+
+INDEX_SUFFIX = '.index'
+# Every record is framed by its uint64 length, the masked crc32 of the length
+# and the masked crc32 of the data.
+RECORD_HEADER = 12
+RECORD_OVERHEAD = 16
+OFFSET_SIZE = 8
+
+
+def index_filename(filename):
+  """Returns the index sidecar of a TFRecord file."""
+  return filename + INDEX_SUFFIX
+
+
+def has_index(filename):
+  """Returns True if the TFRecord file has an index sidecar."""
+  return tf.gfile.Exists(index_filename(filename))
+
+
+def record_offsets(lengths):
+  """Returns the byte offset of every record given their data lengths."""
+  lengths = np.asarray(lengths, dtype=np.int64) + RECORD_OVERHEAD
+  offsets = np.zeros(len(lengths), dtype=np.int64)
+  offsets[1:] = np.cumsum(lengths)[:-1]
+  return offsets
+
+
+def write_index(filename, offsets):
+  """Writes the index sidecar of a TFRecord file."""
+  with tf.gfile.Open(index_filename(filename), 'wb') as f:
+    f.write(np.asarray(offsets, dtype='<i8').tobytes())
+
+
+def build_index(filename):
+  """Writes the sidecar of a TFRecord file written without one.
+  Only the record headers are read. Returns the record offsets.
+  """
+  offsets = []
+  offset = 0
+  with tf.gfile.Open(filename, 'rb') as f:
+    while True:
+      header = f.read(RECORD_HEADER)
+      if not header:
+        break
+      length, = struct.unpack('<Q', header[:8])
+      offsets.append(offset)
+      offset += length + RECORD_OVERHEAD
+      f.seek(offset)
+  write_index(filename, offsets)
+  return np.array(offsets, dtype=np.int64)
+
+
+def read_index(filename):
+  """Returns the byte offsets of the records of a TFRecord file."""
+  with tf.gfile.Open(index_filename(filename), 'rb') as f:
+    return np.frombuffer(f.read(), dtype='<i8').astype(np.int64)
+
+
+def num_records(filename):
+  """Returns the number of records of a TFRecord file, from its sidecar."""
+  return tf.gfile.Stat(index_filename(filename)).length // OFFSET_SIZE
+
+
+def read_record(filename, index):
+  """Returns the serialized record `index` of a TFRecord file.
+  Reads one offset from the sidecar and one record from the file.
+  """
+  if not 0 <= index < num_records(filename):
+    raise IndexError('Record %d out of range in %s' % (index, filename))
+  with tf.gfile.Open(index_filename(filename), 'rb') as f:
+    f.seek(index * OFFSET_SIZE)
+    offset, = struct.unpack('<q', f.read(OFFSET_SIZE))
+  with tf.gfile.Open(filename, 'rb') as f:
+    f.seek(offset)
+    length, = struct.unpack('<Q', f.read(RECORD_HEADER)[:8])
+    return f.read(length)
+
+
+def read_records(filename, start, end):
+  """Returns the serialized records [start, end) of a TFRecord file.
+  The first offset is read from the sidecar and the file is read from there,
+  so the records before `start` are never read.
+  """
+  if not 0 <= start <= end <= num_records(filename):
+    raise IndexError('Records %d to %d out of range in %s' %
+                     (start, end, filename))
+  if start == end:
+    return []
+  with tf.gfile.Open(index_filename(filename), 'rb') as f:
+    f.seek(start * OFFSET_SIZE)
+    offset, = struct.unpack('<q', f.read(OFFSET_SIZE))
+  records = []
+  with tf.gfile.Open(filename, 'rb') as f:
+    f.seek(offset)
+    for _ in range(end - start):
+      length, = struct.unpack('<Q', f.read(RECORD_HEADER)[:8])
+      records.append(f.read(length))
+      f.seek(RECORD_OVERHEAD - RECORD_HEADER, 1)
+  return records
+
+
+def split_records(filenames, num_parts, part):
+  """Splits the records of TFRecord files into contiguous parts.
+  Args:
+    filenames: TFRecord files with sidecars, in record order.
+    num_parts: number of parts of roughly equal sizes.
+    part: index of the part to return.
+  Returns:
+    The list of (filename, start, end) record ranges of the part, end
+    excluded, read from the sidecars only.
+  """
+  if not 0 <= part < num_parts:
+    raise ValueError('Invalid part %d of %d' % (part, num_parts))
+  counts = [num_records(filename) for filename in filenames]
+  total = sum(counts)
+  start = part * total // num_parts
+  end = (part + 1) * total // num_parts
+
+  ranges = []
+  first = 0
+  for filename, count in zip(filenames, counts):
+    low = max(start - first, 0)
+    high = min(end - first, count)
+    if low < high:
+      ranges.append((filename, low, high))
+    first += count
+  return ranges